@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+# Copyright: Damien Elmes <anki@ichi2.net>
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+import os, re
+from anki.db import sqlite
+
+"""
+Online backups, taken while the collection stays open.
+
+The copy is made by a separate connection, which holds a read transaction on
+the collection for the length of the backup. In WAL mode that gives it a
+snapshot of the last committed state, while the collection keeps committing,
+so the rows can be copied a few at a time between reviews. Without WAL the
+read lock would stop the collection from committing, so the whole copy is
+made in the first step.
+
+Python's sqlite module doesn't expose sqlite's backup API, so the rows are
+copied with SQL into the backup file, attached to the same connection.
+"""
+
+# rows copied by each Backup.step()
+BACKUP_ROWS = 5000
+
+class Backup(object):
+    "A backup of the collection at PATH to DEST, made by calling step()."
+
+    def __init__(self, path, dest, rowsPerStep=BACKUP_ROWS, keep=1,
+                 timeout=0):
+        self.dest = dest
+        self.keep = keep
+        self.copied = 0
+        self.done = False
+        self._tmp = dest + ".tmp"
+        if os.path.exists(self._tmp):
+            os.unlink(self._tmp)
+        self._db = sqlite.connect(path, timeout=timeout, isolation_level=None)
+        if self._db.execute("pragma journal_mode").fetchone()[0] != "wal":
+            rowsPerStep = None
+        self.rowsPerStep = rowsPerStep
+        self._db.execute("attach ? as bk", (self._tmp,))
+        for p in "page_size", "auto_vacuum":
+            self._db.execute("pragma bk.%s = %d" % (p, self._db.execute(
+                "pragma main.%s" % p).fetchone()[0]))
+        self._db.execute("begin")
+        # the snapshot is taken on the first read
+        self.mod = self._db.execute("select mod from col").fetchone()[0]
+        self._tables = []
+        self._indices = []
+        for type, name, sql in self._db.execute("""
+select type, name, sql from main.sqlite_master
+where sql is not null and name not like 'sqlite_%'"""):
+            sql = re.sub(r"(?i)^(create\s+(?:unique\s+)?(?:table|index)\s+)",
+                         r"\1bk.", sql)
+            if type == "table":
+                self._db.execute(sql)
+                self._tables.append(name)
+            elif type == "index":
+                self._indices.append(sql)
+        self._stats = self._db.execute("""
+select 1 from main.sqlite_master where name = 'sqlite_stat1'""").fetchone()
+        if self._stats:
+            # while it's empty, so it's quick
+            self._db.execute("analyze bk")
+        self._last = None
+        if self.rowsPerStep is None:
+            self.run()
+
+    def step(self):
+        "Copy the next rows. True when the backup is complete."
+        if self.done:
+            return True
+        if self._tables:
+            self._copy()
+        if self.rowsPerStep is None:
+            while self._tables:
+                self._copy()
+        if not self._tables:
+            self._finish()
+        return self.done
+
+    def _copy(self):
+        table = self._tables[0]
+        where = ""
+        args = []
+        if self._last is not None:
+            where = "where rowid > ?"
+            args.append(self._last)
+        end = None
+        if self.rowsPerStep:
+            # the rowid of the last row in this step, or None if the rest of
+            # the table fits
+            end = self._db.execute(
+                "select rowid from main.%s %s order by rowid limit 1 "
+                "offset ?" % (table, where),
+                args + [self.rowsPerStep - 1]).fetchone()
+        if end:
+            where += (" and " if where else "where ") + "rowid <= ?"
+            args.append(end[0])
+            self._last = end[0]
+        else:
+            self._tables.pop(0)
+            self._last = None
+        cur = self._db.execute(
+            "insert into bk.%s select * from main.%s %s" % (
+                table, table, where), args)
+        self.copied += cur.rowcount
+
+    def run(self):
+        "Step until the backup is complete."
+        while not self.step():
+            pass
+
+    def cancel(self):
+        "Stop the backup, removing the partial copy."
+        if self.done:
+            return
+        self._close()
+        os.unlink(self._tmp)
+        self.done = True
+
+    def _finish(self):
+        for sql in self._indices:
+            self._db.execute(sql)
+        # keep the query planner statistics if the collection has them
+        if self._stats:
+            self._db.execute("delete from bk.sqlite_stat1")
+            self._db.execute(
+                "insert into bk.sqlite_stat1 select * from main.sqlite_stat1")
+        self._close()
+        rotate(self.dest, self.keep)
+        if os.path.exists(self.dest):
+            os.unlink(self.dest)
+        os.rename(self._tmp, self.dest)
+        self.done = True
+
+    def _close(self):
+        self._db.execute("commit")
+        self._db.execute("detach bk")
+        self._db.close()
+
+def rotate(path, keep):
+    """Move col.anki2 to col.1.anki2, col.1.anki2 to col.2.anki2 and so on,
+keeping KEEP in all."""
+    if keep <= 1:
+        return
+    root, ext = os.path.splitext(path)
+    def name(n):
+        if not n:
+            return path
+        return "%s.%d%s" % (root, n, ext)
+    for n in range(keep-1, 0, -1):
+        if os.path.exists(name(n-1)):
+            os.rename(name(n-1), name(n))
+
+def backupMod(path):
+    "The mod time of the collection backed up at PATH, or None."
+    if not os.path.exists(path):
+        return None
+    db = sqlite.connect(path)
+    try:
+        return db.execute("select mod from col").fetchone()[0]
+    except sqlite.Error:
+        return None
+    finally:
+        db.close()
@@ -3,7 +3,7 @@
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
 import time
-from anki.utils import intTime, hexifyID, timestampID
+from anki.utils import intTime, hexifyID
 
 # Cards
 ##########################################################################
@@ -18,17 +18,18 @@ from anki.utils import intTime, hexifyID, timestampID
 
 class Card(object):
 
-    def __init__(self, col, id=None):
+    def __init__(self, col, id=None, row=None):
+        "ROW can be passed with ID if the card has already been read."
         self.col = col
         self.timerStarted = None
         self._qa = None
         self._note = None
         if id:
             self.id = id
-            self.load()
+            self.load(row)
         else:
             # to flush, set nid, ord, and due
-            self.id = timestampID(col.db, "cards")
+            self.id = col.ids.next("cards")
             self.did = 1
             self.crt = intTime()
             self.type = 0
@@ -42,7 +43,7 @@ class Card(object):
             self.flags = 0
             self.data = ""
 
-    def load(self):
+    def load(self, row=None):
         (self.id,
          self.nid,
          self.did,
@@ -59,7 +60,7 @@ class Card(object):
          self.left,
          self.edue,
          self.flags,
-         self.data) = self.col.db.first(
+         self.data) = row or self.col.db.first(
              "select * from cards where id = ?", self.id)
         self._qa = None
         self._note = None
@@ -92,13 +93,18 @@ insert or replace into cards values
     def flushSched(self):
         self.mod = intTime()
         self.usn = self.col.usn()
-        self.col.db.execute(
-            """update cards set
+        # may be queued if the db is in write-behind mode
+        self.col.db.defer(self.schedSQL, *self.schedRow())
+
+    schedSQL = """update cards set
 mod=?, usn=?, type=?, queue=?, due=?, ivl=?, factor=?, reps=?,
-lapses=?, left=?, edue=? where id = ?""",
-            self.mod, self.usn, self.type, self.queue, self.due, self.ivl,
-            self.factor, self.reps, self.lapses,
-            self.left, self.edue, self.id)
+lapses=?, left=?, edue=? where id = ?"""
+
+    def schedRow(self):
+        "Arguments to schedSQL, to write the scheduling fields."
+        return (self.mod, self.usn, self.type, self.queue, self.due, self.ivl,
+                self.factor, self.reps, self.lapses,
+                self.left, self.edue, self.id)
 
     def q(self, reload=False):
         return self.css() + self._getQA(reload)['q']
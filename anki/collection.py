@@ -2,10 +2,13 @@
 # Copyright: Damien Elmes <anki@ichi2.net>
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
-import time, os, random, re, stat, simplejson, datetime, copy, shutil, sys
+import time, os, random, re, stat, simplejson, datetime, copy, shutil, sys, \
+    itertools, multiprocessing, collections
+from operator import itemgetter
+from contextlib import contextmanager
 from anki.lang import _, ngettext
 from anki.utils import ids2str, hexifyID, checksum, fieldChecksum, stripHTML, \
-    intTime, splitFields, joinFields, maxID
+    intTime, splitFields, joinFields, IdAllocator
 from anki.hooks import runHook, runFilter
 from anki.sched import Scheduler
 from anki.models import ModelManager
@@ -14,9 +17,12 @@ from anki.decks import DeckManager
 from anki.tags import TagManager
 from anki.consts import *
 from anki.errors import AnkiError
+from anki.db import ReadPool, ITER_BATCH
+from anki.backup import Backup, BACKUP_ROWS, backupMod
 
 import anki.latex # sets up hook
-import anki.cards, anki.notes, anki.template, anki.cram, anki.find
+import anki.cards, anki.notes, anki.template, anki.cram, anki.find, \
+    anki.registry
 
 defaultConf = {
     # review options
@@ -34,14 +40,40 @@ defaultConf = {
     'sortBackwards': False,
 }
 
+# fixIntegrity() vacuums if at least this fraction of the file is unused
+VACUUM_FREE = 0.1
+
+# maintain(): default seconds to spend, pages freed per step, and rows
+# sampled per index when updating statistics
+MAINT_BUDGET = 0.5
+VACUUM_STEP = 500
+ANALYSIS_LIMIT = 1000
+
+# the collection being rendered, in render worker processes
+_renderCol = None
+_renderCache = None
+
+def _renderChunk(rows):
+    # each worker keeps its own copy of the cache across chunks
+    return _renderCol._renderChunk(rows, _renderCache)
+
 # this is initialized by storage.Collection
 class _Collection(object):
 
-    def __init__(self, db, server=False):
+    def __init__(self, db, server=False, profile=None):
         self.db = db
         self.path = db._path
         self.server = server
+        # the storage profile the collection was opened with, if any
+        self.profile = profile
+        self.readOnly = bool(profile and profile['readOnly'])
+        self._openReadPool()
+        self.ids = IdAllocator(db)
         self._lastSave = time.time()
+        self.undoLimit = UNDO_REVIEWS
+        self.pendingChecks = []
+        # the backup being made by backup(), if any
+        self._backup = None
         self.clearUndo()
         self.media = MediaManager(self)
         self.models = ModelManager(self)
@@ -61,7 +93,8 @@ class _Collection(object):
         self._stdSched = Scheduler(self)
         self.sched = self._stdSched
         # check for improper shutdown
-        self.cleanup()
+        if not self.readOnly:
+            self.cleanup()
 
     def name(self):
         n = os.path.splitext(os.path.basename(self.path))[0]
@@ -70,24 +103,43 @@ class _Collection(object):
     # DB-related
     ##########################################################################
 
-    def load(self):
+    def load(self, onlyChanged=False):
+        """Load the col row. With ONLYCHANGED, registries without unsaved
+changes are kept, as they already match the db."""
+        if not onlyChanged:
+            (self.crt,
+             self.mod,
+             self.scm,
+             self.dty,
+             self._usn,
+             self.ls,
+             self.conf,
+             models,
+             decks,
+             dconf,
+             tags) = self.db.first("""
+select crt, mod, scm, dty, usn, ls,
+conf, models, decks, dconf, tags from col""")
+            self.conf = simplejson.loads(self.conf)
+            self.models.load(models)
+            self.decks.load(decks, dconf)
+            self.tags.load(tags)
+            return
         (self.crt,
          self.mod,
          self.scm,
          self.dty,
          self._usn,
          self.ls,
-         self.conf,
-         models,
-         decks,
-         dconf,
-         tags) = self.db.first("""
-select crt, mod, scm, dty, usn, ls,
-conf, models, decks, dconf, tags from col""")
+         self.conf) = self.db.first("""
+select crt, mod, scm, dty, usn, ls, conf from col""")
         self.conf = simplejson.loads(self.conf)
-        self.models.load(models)
-        self.decks.load(decks, dconf)
-        self.tags.load(tags)
+        if self.models.changed:
+            self.models.load(self.db.scalar("select models from col"))
+        if self.decks.changed:
+            self.decks.load(*self.db.first("select decks, dconf from col"))
+        if self.tags.changed:
+            self.tags.load(self.db.scalar("select tags from col"))
 
     def setMod(self):
         """Mark DB modified.
@@ -126,6 +178,8 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
             self.save()
 
     def lock(self):
+        if self.readOnly:
+            return
         # make sure we don't accidentally bump mod time
         mod = self.db.mod
         self.db.execute("update col set mod=mod")
@@ -134,12 +188,23 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
     def close(self, save=True):
         "Disconnect from DB."
         if self.db:
-            self.cleanup()
+            # an unfinished backup is completed, as its connection would
+            # stop us leaving wal mode
+            if self._backup:
+                self._backup.run()
+                self._backup = None
+            if self.readOnly:
+                save = False
+            else:
+                self.cleanup()
             if save:
                 self.save()
             else:
                 self.rollback()
-            if not self.server:
+            # leaving wal mode needs the only connection
+            if self.readPool:
+                self.readPool.close()
+            if not self.server and not self.readOnly:
                 self.db.execute("pragma journal_mode = delete")
             self.db.close()
             self.db = None
@@ -147,16 +212,36 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
 
     def reopen(self):
         "Reconnect to DB (after changing threads, etc)."
-        import anki.db
+        import anki.db, anki.storage
         if not self.db:
-            self.db = anki.db.DB(self.path)
+            if self.profile:
+                self.db = anki.db.DB(self.path, timeout=self.profile['timeout'])
+                anki.storage._setProfile(self.db, self.profile)
+                if self.readOnly:
+                    self.db.setQueryOnly()
+            else:
+                self.db = anki.db.DB(self.path)
+            self._openReadPool()
+            self.ids = IdAllocator(self.db)
             self.media.connect()
 
     def rollback(self):
         self.db.rollback()
-        self.load()
+        self.ids.reset()
+        self.load(onlyChanged=True)
         self.lock()
 
+    @contextmanager
+    def bulk(self, dropIndices=False):
+        """Do a large import or rewrite with DB.bulk(). If it fails, the
+registries are reloaded along with the rolled back db."""
+        try:
+            with self.db.bulk(dropIndices=dropIndices):
+                yield
+        except:
+            self.rollback()
+            raise
+
     def modSchema(self, check=True):
         "Mark schema modified. Call this first so user can abort if necessary."
         if not self.schemaChanged():
@@ -207,10 +292,11 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
     ##########################################################################
 
     def nextID(self, type, inc=True):
+        "INC may also be a number of ids to reserve."
         type = "next"+type.capitalize()
         id = self.conf.get(type, 1)
         if inc:
-            self.conf[type] = id+1
+            self.conf[type] = id+inc
         return id
 
     def reset(self):
@@ -250,19 +336,78 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
             ncards += 1
         return ncards
 
+    def addNotes(self, notes):
+        """Add new NOTES in bulk. Return the number of new cards.
+Notes are written a batch at a time, so NOTES may be a generator. Like
+addNote(), notes without any non-empty templates are skipped."""
+        ncards = 0
+        tags = set()
+        for batch in self._batches(notes):
+            ncards += self._addNotes(batch, tags)
+        self.tags.register(tags)
+        return ncards
+
+    def _batches(self, items):
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= ITER_BATCH:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _addNotes(self, notes, tags):
+        add = []
+        for note in notes:
+            assert note.scm == self.scm
+            cms = self.findTemplates(note)
+            if cms:
+                add.append((note, cms))
+        if not add:
+            return 0
+        due = self.nextID("pos", len(add))
+        mod = intTime()
+        usn = self.usn()
+        nrows = []
+        crows = []
+        for note, cms in add:
+            note.mod = mod
+            note.usn = usn
+            m = note.model()
+            nrows.append((
+                note.id, note.guid, note.mid, note.did, mod, usn,
+                note.stringTags(), note.joinedFields(),
+                stripHTML(note.fields[self.models.sortIdx(m)]),
+                fieldChecksum(note.fields[0]), note.flags, note.data))
+            tags.update(note.tags)
+            for t in cms:
+                did = t['did'] or note.did
+                crows.append((note.id, did, t['ord'], mod, usn,
+                              self._dueForDid(did, due)))
+            due += 1
+        cid = self.ids.take("cards", len(crows))
+        self.db.executemany("""
+insert or replace into notes values (?,?,?,?,?,?,?,?,?,?,?,?)""", nrows)
+        self.db.executemany("""
+insert into cards values (?,?,?,?,?,?,0,0,?,0,0,0,0,0,0,0,"")""",
+            [(cid+c,)+r for c, r in enumerate(crows)])
+        return len(crows)
+
     def remNotes(self, ids):
-        self.remCards(self.db.list("select id from cards where nid in "+
-                                   ids2str(ids)))
+        with self.db.idSet(ids) as sids:
+            cids = self.db.list("select id from cards where nid in "+sids)
+        self.remCards(cids)
 
     def _remNotes(self, ids):
         "Bulk delete notes by ID. Don't call this directly."
         if not ids:
             return
-        strids = ids2str(ids)
         # we need to log these independently of cards, as one side may have
         # more card templates
         self._logRem(ids, REM_NOTE)
-        self.db.execute("delete from notes where id in %s" % strids)
+        with self.db.idSet(ids) as sids:
+            self.db.execute("delete from notes where id in %s" % sids)
 
     # Card creation
     ##########################################################################
@@ -280,37 +425,47 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
 
     def genCards(self, nids):
         "Generate cards for non-empty templates, return ids to remove."
+        # a batch at a time, so memory use doesn't grow with the note count
+        rem = []
+        for batch in self._batches(nids):
+            rem.extend(self._genCards(batch))
+        return rem
+
+    def _genCards(self, nids):
         # build map of (nid,ord) so we don't create dupes
-        snids = ids2str(nids)
         have = {}
-        for id, nid, ord in self.db.execute(
-            "select id, nid, ord from cards where nid in "+snids):
-            if nid not in have:
-                have[nid] = {}
-            have[nid][ord] = id
-        # build cards for each note
         data = []
-        ts = maxID(self.db)
         now = intTime()
         rem = []
         usn = self.usn()
-        for nid, mid, did, flds in self.db.execute(
-            "select id, mid, did, flds from notes where id in "+snids):
+        with self.db.idSet(nids) as snids:
+            for id, nid, ord in self.db.execute(
+                "select id, nid, ord from cards where nid in "+snids):
+                if nid not in have:
+                    have[nid] = {}
+                have[nid][ord] = id
+            # build cards for each note, a model at a time
+            notes = self.db.all(
+                "select id, mid, did, flds from notes where id in %s "
+                "order by mid" % snids)
+        for mid, rows in itertools.groupby(notes, itemgetter(1)):
             model = self.models.get(mid)
-            avail = self.models.availOrds(model, flds)
-            ok = []
-            for t in model['tmpls']:
-                doHave = nid in have and t['ord'] in have[nid]
-                # if have ord but empty, add cid to remove list
-                # (may not have nid if generating before any cards added)
-                if doHave and t['ord'] not in avail:
-                    rem.append(have[nid][t['ord']])
-                # if missing ord and is available, generate
-                if not doHave and t['ord'] in avail:
-                    data.append((ts, nid, t['did'] or did, t['ord'],
-                                 now, usn, nid))
-                    ts += 1
-        # bulk update
+            tmpls = [(t['ord'], t['did']) for t in model['tmpls']]
+            for nid, mid, did, flds in rows:
+                avail = set(self.models.availOrds(model, flds))
+                cur = have.get(nid, {})
+                for ord, tdid in tmpls:
+                    doHave = ord in cur
+                    # if have ord but empty, add cid to remove list
+                    # (may not have nid if generating before any cards added)
+                    if doHave and ord not in avail:
+                        rem.append(cur[ord])
+                    # if missing ord and is available, generate
+                    if not doHave and ord in avail:
+                        data.append((nid, tdid or did, ord, now, usn, nid))
+        # bulk update, with a block of ids
+        ts = self.ids.take("cards", len(data))
+        data = [(ts+c,)+d for c, d in enumerate(data)]
         self.db.executemany("""
 insert into cards values (?,?,?,?,?,?,0,0,?,0,0,0,0,0,0,0,"")""",
                             data)
@@ -369,16 +524,18 @@ insert into cards values (?,?,?,?,?,?,0,0,?,0,0,0,0,0,0,0,"")""",
         "Bulk delete cards by ID."
         if not ids:
             return
-        sids = ids2str(ids)
-        nids = self.db.list("select nid from cards where id in "+sids)
-        # remove cards
-        self._logRem(ids, REM_CARD)
-        self.db.execute("delete from cards where id in "+sids)
-        self.db.execute("delete from revlog where cid in "+sids)
+        with self.db.idSet(ids) as sids:
+            nids = self.db.list("select nid from cards where id in "+sids)
+            # remove cards
+            self._logRem(ids, REM_CARD)
+            with self.sched.cardsChanging(ids):
+                self.db.execute("delete from cards where id in "+sids)
+            self.db.execute("delete from revlog where cid in "+sids)
         # then notes
-        nids = self.db.list("""
+        with self.db.idSet(nids) as snids:
+            nids = self.db.list("""
 select id from notes where id in %s and id not in (select nid from cards)""" %
-                     ids2str(nids))
+                                snids)
         self._remNotes(nids)
 
     def remEmptyCards(self, ids):
@@ -390,64 +547,130 @@ select id from notes where id in %s and id not in (select nid from cards)""" %
     # Field checksums and sorting fields
     ##########################################################################
 
-    def _fieldData(self, snids):
-        return self.db.execute(
-            "select id, mid, flds from notes where id in "+snids)
-
-    def updateFieldCache(self, nids):
-        "Update field checksums and sort cache, after find&replace, etc."
-        snids = ids2str(nids)
-        r = []
-        for (nid, mid, flds) in self._fieldData(snids):
-            fields = splitFields(flds)
-            model = self.models.get(mid)
-            r.append((stripHTML(fields[self.models.sortIdx(model)]),
-                      fieldChecksum(fields[0]),
-                      nid))
-        # apply, relying on calling code to bump usn+mod
-        self.db.executemany("update notes set sfld=?, csum=? where id=?", r)
+    def updateFieldCache(self, nids=None, csum=True):
+        """Update field checksums and sort cache, after find&replace, etc.
+If NIDS is None, every note is updated. The work is done inside sqlite, with
+one statement per model."""
+        cols = "sfld = stripHTML(field(flds, ?))"
+        if csum:
+            cols += ", csum = fieldChecksum(field(flds, 0))"
+        # notes with a missing model are left alone, as there's nothing to
+        # sort on. apply, relying on calling code to bump usn+mod
+        if nids is None:
+            for m in self.models.all():
+                self.db.execute(
+                    "update notes set %s where mid = ?" % cols,
+                    self.models.sortIdx(m), m['id'])
+            return
+        with self.db.idSet(nids) as snids:
+            for mid in self.db.list(
+                "select distinct mid from notes where id in "+snids):
+                m = self.models.get(mid)
+                if not m:
+                    continue
+                self.db.execute(
+                    "update notes set %s where mid = ? and id in %s" % (
+                        cols, snids), self.models.sortIdx(m), mid)
 
     # Q/A generation
     ##########################################################################
 
-    def renderQA(self, ids=None, type="card"):
+    def renderQA(self, ids=None, type="card", processes=None):
+        """Render the cards selected by IDS and TYPE, as a list of dicts with
+id, q and a. With PROCESSES, rendering is spread over a pool of processes."""
+        return list(self.iterQA(ids, type, processes))
+
+    def iterQA(self, ids=None, type="card", processes=None):
+        """Like renderQA(), but yield each card as it's rendered, reading the
+cards a batch at a time. Don't commit before the iterator is exhausted."""
         # gather metadata
         if type == "card":
-            where = "and c.id in " + ids2str(ids)
+            where = "and c.id in "
         elif type == "note":
-            where = "and f.id in " + ids2str(ids)
+            where = "and f.id in "
         elif type == "model":
-            where = "and m.id in " + ids2str(ids)
+            where = "and f.mid in "
         elif type == "all":
             where = ""
         else:
             raise Exception()
-        return [self._renderQA(row)
-                for row in self._qaData(where)]
-
-    def _renderQA(self, data):
+        with self.db.idSet(ids or []) as sids:
+            if where:
+                where += sids
+            chunks = self._batches(self._qaData(where))
+            # models can't change while rendering, so their field maps and
+            # compiled templates are kept for the whole call
+            cache = {}
+            if processes > 1 and hasattr(os, "fork"):
+                results = self._renderParallel(chunks, processes, cache)
+            else:
+                results = (self._renderChunk(c, cache) for c in chunks)
+            for chunk in results:
+                for d in chunk:
+                    yield d
+
+    def _renderChunk(self, rows, cache=None):
+        return [self._renderQA(row, cache) for row in rows]
+
+    def _renderParallel(self, chunks, processes, cache):
+        global _renderCol, _renderCache
+        # workers are forked with a copy of the collection, and must not
+        # touch the db, so make sure the registries have been loaded
+        self.models.models
+        self.decks.decks
+        _renderCol = self
+        _renderCache = cache
+        pool = multiprocessing.Pool(processes)
+        # the cursor can only be read from this thread, so chunks are handed
+        # out here, keeping a few queued for each worker
+        pending = collections.deque()
+        try:
+            for chunk in chunks:
+                pending.append(pool.apply_async(_renderChunk, (chunk,)))
+                if len(pending) >= processes*2:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            _renderCol = None
+            _renderCache = None
+
+    def _renderQA(self, data, cache=None):
         "Returns hash of id, question, answer."
         # data is [cid, nid, mid, did, ord, tags, flds]
+        if cache is not None and (data[2], data[4]) in cache:
+            model, fmap, tmpls = cache[(data[2], data[4])]
+        else:
+            model = self.models.get(data[2])
+            fmap = [(name, idx) for (name, (idx, conf))
+                    in self.models.fieldMap(model).items()]
+            template = model['tmpls'][data[4]]
+            tmpls = (template['name'],
+                     anki.template.Template(
+                         template['qfmt'].replace("cloze:", "cq:")),
+                     anki.template.Template(
+                         template['afmt'].replace("cloze:", "ca:")))
+            # templates that change the delimiters can't be reused
+            if cache is not None and "{{=" not in (
+                template['qfmt'] + template['afmt']):
+                cache[(data[2], data[4])] = model, fmap, tmpls
         # unpack fields and create dict
         flist = splitFields(data[6])
         fields = {}
-        model = self.models.get(data[2])
-        for (name, (idx, conf)) in self.models.fieldMap(model).items():
+        for name, idx in fmap:
             fields[name] = flist[idx]
         fields['Tags'] = data[5]
         fields['Type'] = model['name']
         fields['Deck'] = self.decks.name(data[3])
-        template = model['tmpls'][data[4]]
-        fields['Card'] = template['name']
+        fields['Card'] = tmpls[0]
         # render q & a
         d = dict(id=data[0])
-        for (type, format) in (("q", template['qfmt']), ("a", template['afmt'])):
-            if type == "q":
-                format = format.replace("cloze:", "cq:")
-            else:
-                format = format.replace("cloze:", "ca:")
+        for (type, tmpl) in (("q", tmpls[1]), ("a", tmpls[2])):
             fields = runFilter("mungeFields", fields, model, data, self)
-            html = anki.template.render(format, fields)
+            html = tmpl.render(context=fields.copy())
             d[type] = runFilter(
                 "mungeQA", html, type, fields, model, data, self)
         return d
@@ -463,8 +686,8 @@ where c.nid == f.id
     # Finding cards
     ##########################################################################
 
-    def findCards(self, query, full=False):
-        return anki.find.Finder(self).findCards(query, full)
+    def findCards(self, query, full=False, db=None):
+        return anki.find.Finder(self, db).findCards(query, full)
 
     def findReplace(self, nids, src, dst, regex=None, field=None, fold=True):
         return anki.find.findReplace(self, nids, src, dst, regex, field, fold)
@@ -475,13 +698,43 @@ where c.nid == f.id
     # Stats
     ##########################################################################
 
-    def cardStats(self, card):
+    def cardStats(self, card, db=None):
         from anki.stats import CardStats
-        return CardStats(self, card).report()
+        return CardStats(self, card, db).report()
 
-    def stats(self):
+    def stats(self, db=None):
         from anki.stats import CollectionStats
-        return CollectionStats(self)
+        return CollectionStats(self, db)
+
+    # Concurrent reads
+    ##########################################################################
+
+    def _openReadPool(self):
+        # without wal, readers' locks would stop the collection committing
+        if self.db.scalar("pragma journal_mode") == "wal":
+            self.readPool = ReadPool(self.path, timeout=self.db._timeout)
+        else:
+            self.readPool = None
+
+    @contextmanager
+    def reader(self):
+        """A read-only connection for use from another thread, as a context
+manager. It can be passed to findCards(), cardStats() and stats(), and only
+sees changes that have been saved. Collections not in WAL mode have no
+separate readers, so the collection's own connection is used, from the
+main thread only."""
+        if self.readPool:
+            with self.readPool.reader() as db:
+                # registries in tables that haven't been loaded yet are read
+                # through the reader, as this may be another thread
+                for mgr, name in ((self.models, "models"),
+                                  (self.decks, "decks"),
+                                  (self.decks, "dconf"),
+                                  (self.tags, "tags")):
+                    getattr(type(mgr), name).load(mgr, db)
+                yield db
+        else:
+            yield self.db
 
     # Timeboxing
     ##########################################################################
@@ -529,6 +782,8 @@ where c.nid == f.id
     def clearUndo(self):
         # [type, undoName, data]
         # type 1 = review; type 2 = checkpoint
+        # review data is a deque of the cards' scheduling state before each
+        # answer, holding at most undoLimit entries
         self._undo = None
 
     def undoName(self):
@@ -543,25 +798,32 @@ where c.nid == f.id
         else:
             self._undoOp()
 
-    def markReview(self, card):
-        old = []
-        if self._undo:
-            if self._undo[0] == 1:
-                old = self._undo[2]
-            self.clearUndo()
-        self._undo = [1, _("Review"), old + [copy.copy(card)]]
+    def markReview(self, card, state=None):
+        "STATE, from reviewState(), is saved instead of CARD's current state."
+        if not self._undo or self._undo[0] != 1:
+            self._undo = [1, _("Review"),
+                          collections.deque(maxlen=self.undoLimit)]
+        self._undo[2].append(state or self.reviewState(card))
+
+    def reviewState(self, card):
+        "The scheduling fields of CARD that undoing a review restores."
+        return (card.type, card.queue, card.due, card.ivl, card.factor,
+                card.reps, card.lapses, card.left, card.edue, card.id)
 
     def _undoReview(self):
         data = self._undo[2]
-        c = data.pop()
+        state = data.pop()
         if not data:
             self.clearUndo()
         # write old data
-        c.flush()
+        self.db.execute("""update cards set
+mod=?, usn=?, type=?, queue=?, due=?, ivl=?, factor=?, reps=?,
+lapses=?, left=?, edue=? where id = ?""",
+                        intTime(), self.usn(), *state)
         # and delete revlog entry
         last = self.db.scalar(
             "select id from revlog where cid = ? "
-            "order by id desc limit 1", c.id)
+            "order by id desc limit 1", state[-1])
         self.db.execute("delete from revlog where id = ?", last)
 
     def _markOp(self, name):
@@ -580,34 +842,135 @@ where c.nid == f.id
     # DB maintenance
     ##########################################################################
 
-    def fixIntegrity(self):
-        "Fix possible problems and rebuild caches."
+    # the stages of fixIntegrity(), in the order they're run
+    checkStages = ("check", "notes", "tags", "fields", "optimize")
+
+    def fixIntegrity(self, quick=False, stages=None, budget=None):
+        """Fix possible problems and rebuild caches.
+The work is split into checkStages. Changes are saved after each stage, and
+the fixIntegrityProgress hook is run with the stage and the number of stages
+done so far. QUICK uses sqlite's quick_check instead of a full integrity check.
+With BUDGET, no new stage is started after that many seconds; the rest are
+left in .pendingChecks, which can be passed back as STAGES to resume. The
+budget is only checked between stages, so a long stage can run past it; the
+tags and fields stages each go through every note."""
+        if stages is None:
+            stages = self.checkStages
+        stages = list(stages)
+        for stage in stages:
+            if stage not in self.checkStages:
+                raise Exception("Unknown check stage: %s" % stage)
         problems = []
         self.save()
         oldSize = os.stat(self.path)[stat.ST_SIZE]
-        if self.db.scalar("pragma integrity_check") != "ok":
+        start = time.time()
+        done = []
+        while stages:
+            if budget is not None and time.time() - start >= budget:
+                break
+            stage = stages.pop(0)
+            err = getattr(self, "_check" + stage.capitalize())(quick)
+            if err:
+                self.pendingChecks = []
+                return err
+            self.save()
+            done.append(stage)
+            runHook("fixIntegrityProgress", stage, len(done))
+        self.pendingChecks = stages
+        if stages:
+            txt = _("Database partially checked.")
+        elif "optimize" in done:
+            newSize = os.stat(self.path)[stat.ST_SIZE]
+            save = (oldSize - newSize)/1024
+            txt = _("Database rebuilt and optimized.")
+            if save > 0:
+                txt += "\n" + _("Saved %dKB.") % save
+        else:
+            txt = _("Database rebuilt.")
+        problems.append(txt)
+        return "\n".join(problems)
+
+    def _checkCheck(self, quick):
+        check = "quick_check" if quick else "integrity_check"
+        if self.db.scalar("pragma %s" % check) != "ok":
             return _("Collection is corrupt. Please see the manual.")
+        # indices may be missing if a bulk import was interrupted
+        import anki.storage
+        anki.storage._updateIndices(self.db)
+        if self.models.table:
+            anki.registry.addTables(self.db)
+
+    def _checkNotes(self, quick):
         # delete any notes with missing cards
         ids = self.db.list("""
 select id from notes where id not in (select distinct nid from cards)""")
         self._remNotes(ids)
-        # tags
+
+    def _checkTags(self, quick):
         self.tags.registerNotes()
-        # field cache
-        for m in self.models.all():
-            self.updateFieldCache(self.models.nids(m))
-        # and finally, optimize
-        self.optimize()
-        newSize = os.stat(self.path)[stat.ST_SIZE]
-        save = (oldSize - newSize)/1024
-        txt = _("Database rebuilt and optimized.")
-        if save > 0:
-            txt += "\n" + _("Saved %dKB.") % save
-        problems.append(txt)
-        self.save()
-        return "\n".join(problems)
 
-    def optimize(self):
-        self.db.execute("vacuum")
+    def _checkFields(self, quick):
+        self.updateFieldCache()
+
+    def _checkOptimize(self, quick):
+        self.optimize(VACUUM_FREE)
+
+    def optimize(self, minFree=0):
+        """Vacuum if at least MINFREE of the file's pages are unused, and
+update the query planner's statistics."""
+        free = self.db.scalar("pragma freelist_count")
+        if free >= minFree*self.db.scalar("pragma page_count"):
+            # older collections are moved to incremental vacuum on the way
+            self.db.execute("pragma auto_vacuum = incremental")
+            self.db.execute("vacuum")
         self.db.execute("analyze")
         self.lock()
+
+    def maintain(self, budget=MAINT_BUDGET):
+        """Do some housekeeping when idle, stopping once BUDGET seconds have
+been used: checkpoint the WAL, return free pages to the OS if the collection
+uses incremental vacuum, and update statistics for tables that have changed
+a lot. Any changes are saved first."""
+        self.save()
+        end = time.time() + budget
+        if self.db.scalar("pragma journal_mode") == "wal":
+            self.db.execute("pragma wal_checkpoint(passive)")
+        if self.db.scalar("pragma auto_vacuum") == 2:
+            while time.time() < end and self.db.scalar(
+                "pragma freelist_count"):
+                # a page is freed each time the statement is stepped
+                self.db.all("pragma incremental_vacuum(%d)" % VACUUM_STEP)
+        if time.time() < end:
+            self.db.execute("pragma analysis_limit = %d" % ANALYSIS_LIMIT)
+            self.db.execute("pragma optimize")
+        self.lock()
+
+    def backup(self, path, rowsPerStep=BACKUP_ROWS, keep=1):
+        """Start backing up the collection to PATH while it stays open. Returns
+a Backup to step() between reviews, or None if PATH already holds the
+collection as last saved. Older backups are moved to col.1.anki2 and so
+on, keeping KEEP in all. Unsaved changes aren't included. An unfinished
+backup is completed before another is started, or the collection closed."""
+        # only one backup's connection is kept open at a time
+        if self._backup:
+            self._backup.run()
+            self._backup = None
+        if backupMod(path) == self.mod:
+            return None
+        self._backup = Backup(self.path, path, rowsPerStep, keep,
+                              timeout=self.db._timeout)
+        return self._backup
+
+    def useRegistryTables(self):
+        """Store models, decks, deck configs and tags as a row each, instead of
+as JSON in the col table. Requires a full sync."""
+        if not self.models.table:
+            self.modSchema()
+            # commits, so the conversion below is a transaction of its own
+            anki.registry.addTables(self.db)
+            self.models.useTable()
+            self.decks.useTables()
+            self.tags.useTable()
+            self.db.execute(
+                "update col set models='', decks='', dconf='', tags=''")
+        self.save()
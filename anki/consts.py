@@ -27,6 +27,9 @@ REM_DECK = 2
 COUNT_ANSWERED = 0
 COUNT_REMAINING = 1
 
+# number of reviews that can be undone
+UNDO_REVIEWS = 100
+
 # media log
 MEDIA_ADD = 0
 MEDIA_REM = 1
@@ -12,6 +12,8 @@ class CramScheduler(Scheduler):
 
     def __init__(self, col, order, min=0, max=None):
         Scheduler.__init__(self, col)
+        # the cram queues are kept differently, so they aren't prefetched
+        self.prefetch = 0
         # should be the opposite order of what you want
         self.order = order
         # days to limit cram to, where tomorrow=0. Max is inclusive.
@@ -30,6 +32,11 @@ class CramScheduler(Scheduler):
         self._resetRev()
 
     def answerCard(self, card, ease):
+        self._answerCard(card, ease)
+        card.mod = intTime()
+        card.flushSched()
+
+    def _answerCard(self, card, ease):
         if card.queue == 2:
             card.queue = 1
             card.edue = card.due
@@ -44,8 +51,6 @@ class CramScheduler(Scheduler):
                 card.ivl = max(1, int(card.ivl * conf['mult']))
                 # mark card as due today so that it doesn't get rescheduled
                 card.due = card.edue = self.today
-        card.mod = intTime()
-        card.flushSched()
 
     def countIdx(self, card):
         if card.queue == 2:
@@ -2,29 +2,120 @@
 # Copyright: Damien Elmes <anki@ichi2.net>
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
-import os, time
+import os, time, re, sys, random, simplejson, itertools, threading
+from contextlib import contextmanager
+from operator import itemgetter
 try:
     from pysqlite2 import dbapi2 as sqlite
 except ImportError:
     from sqlite3 import dbapi2 as sqlite
 
 from anki.hooks import runHook
+from anki.utils import ids2str, stripHTML, fieldChecksum
+
+# statements are classified once and then looked up by their text. ids2str()
+# style statements are unique on every call, so very long statements are
+# classified but not remembered.
+STMT_CACHE = 500
+STMT_MAXLEN = 1000
+
+# id lists shorter than this are inlined rather than loaded into a temp table
+IDSET_MIN = 50
+
+# rows fetched at a time by DB.iter()
+ITER_BATCH = 1000
+
+# page cache used by DB.bulk()
+BULK_CACHE = 50000
+
+# default write-behind batch size, in statements
+WRITE_QUEUE = 200
+
+# maximum read-only connections opened by a ReadPool
+READ_POOL = 4
+
+_writeRe = re.compile(
+    r"^\s*(?:insert(?:\s+or\s+\w+)?\s+into|replace\s+into|update(?:\s+or\s+\w+)?"
+    r"|delete\s+from)\s+(\w+)", re.I)
+_readRe = re.compile(r"\bfrom\s+(\w+)", re.I)
+
+def classify(sql):
+    "Return (isWrite, table) for SQL. Table is None if it can't be found."
+    m = _writeRe.match(sql)
+    if m:
+        return True, m.group(1).lower()
+    m = _readRe.search(sql)
+    if m:
+        return False, m.group(1).lower()
+    return False, None
 
 class DB(object):
-    def __init__(self, path, text=None, timeout=0):
-        self._db = sqlite.connect(path, timeout=timeout)
+    def __init__(self, path, text=None, timeout=0, stmtCache=100,
+                 readOnly=False):
+        # stmtCache is passed to sqlite as cached_statements, so the hot
+        # queries are compiled once per connection
+        if readOnly:
+            # pool connections are handed between threads and manage their
+            # own transactions
+            self._db = sqlite.connect(path, timeout=timeout,
+                                      cached_statements=stmtCache,
+                                      check_same_thread=False,
+                                      isolation_level=None)
+        else:
+            self._db = sqlite.connect(path, timeout=timeout,
+                                      cached_statements=stmtCache)
         if text:
             self._db.text_factory = text
         self._path = path
+        self._timeout = timeout
+        self._explainDb = None
+        self._idSets = 0
+        addFunctions(self._db)
+        if readOnly:
+            # query_only also refuses temp table writes, so id sets are
+            # inlined
+            self._db.execute("pragma query_only = 1")
+            self._haveIdSets = False
+        else:
+            self._haveIdSets = self._initTemp(self._db)
         self.echo = os.environ.get("DBECHO")
         self.mod = False
+        self.profiler = None
+        self.slowThreshold = None
+        self.slowQueries = []
+        self._stmts = {}
+        self._refs = {}
+        self._updateTimed()
+        self._wbSize = None
+        self._pending = []
+        self._pendingTables = set()
+        self._writes = {}
+        self._resets = 0
+
+    def _classify(self, sql):
+        try:
+            return self._stmts[sql]
+        except KeyError:
+            pass
+        c = classify(sql)
+        if len(sql) <= STMT_MAXLEN:
+            if len(self._stmts) >= STMT_CACHE:
+                self._stmts.clear()
+            self._stmts[sql] = c
+        return c
 
     def execute(self, sql, *a, **ka):
-        s = sql.strip().lower()
+        return self._run(sql, a, ka)
+
+    def _run(self, sql, a, ka, fetch=None, flush=True):
+        # make sure queued writes are visible
+        if flush and self._pending and self._touchesPending(sql):
+            self.flushWrites()
         # mark modified?
-        for stmt in "insert", "update", "delete":
-            if s.startswith(stmt):
-                self.mod = True
+        write, table = self._classify(sql)
+        if write:
+            self.mod = True
+            self._wrote(table)
         t = time.time()
         if ka:
             # execute("...where id = :id", id=5)
@@ -32,53 +123,330 @@ class DB(object):
         else:
             # execute("...where id = ?", 5)
             res = self._db.execute(sql, a)
-        if self.echo:
-            #print a, ka
-            print sql, "%0.3fms" % ((time.time() - t)*1000)
+        rows = None
+        if fetch:
+            res = fetch(res)
+            if isinstance(res, list):
+                rows = len(res)
+            else:
+                rows = int(res is not None)
+        elif write:
+            rows = res.rowcount
+        if self._timed:
+            self._done(sql, t, rows, ka or a)
         return res
 
+    def _done(self, sql, t, rows=None, args=None):
+        """Report a finished statement that was started at T. ARGS are the
+bound parameters, or None if the statement can't be explained."""
+        elapsed = time.time() - t
+        if self.echo:
+            print sql, "%0.3fms" % (elapsed*1000)
+        caller = _caller()
+        if self.profiler:
+            self.profiler.record(sql, elapsed, rows, caller)
+        if (self.slowThreshold is not None and
+            elapsed*1000 >= self.slowThreshold):
+            self._logSlow(sql, elapsed, args, caller)
+
     def executemany(self, sql, l):
+        self.flushWrites()
+        self._wrote(self._classify(sql)[1])
+        self._executemany(sql, l)
+
+    def _executemany(self, sql, l):
         self.mod = True
         t = time.time()
-        self._db.executemany(sql, l)
-        if self.echo:
-            print sql, "%0.3fms" % ((time.time() - t)*1000)
+        if self._timed:
+            # remember the last parameters so a slow statement can be
+            # explained without holding the whole list in memory
+            last = [()]
+            def track(l):
+                for x in l:
+                    last[0] = x
+                    yield x
+            res = self._db.executemany(sql, track(l))
+            self._done(sql, t, res.rowcount, last[0])
+        else:
+            self._db.executemany(sql, l)
 
     def commit(self):
+        self.flushWrites()
         t = time.time()
         self._db.commit()
-        if self.echo:
-            print "commit %0.3fms" % ((time.time() - t)*1000)
+        if self._timed:
+            self._done("commit", t)
 
     def executescript(self, sql):
+        self.flushWrites()
         self.mod = True
+        self._resets += 1
         if self.echo:
             print sql
         self._db.executescript(sql)
 
     def rollback(self):
+        # queued writes belong to the transaction being discarded
+        self._pending = []
+        self._pendingTables = set()
+        self._resets += 1
         self._db.rollback()
 
     def scalar(self, *a, **kw):
-        res = self.execute(*a, **kw).fetchone()
+        res = self._run(a[0], a[1:], kw, lambda c: c.fetchone())
+        if res:
+            return res[0]
+        return None
+
+    def peek(self, sql, *a):
+        """Like scalar(), but queued writes aren't flushed first. Only for
+reads the queued writes can't change."""
+        res = self._run(sql, a, None, lambda c: c.fetchone(), flush=False)
         if res:
             return res[0]
         return None
 
     def all(self, *a, **kw):
-        return self.execute(*a, **kw).fetchall()
+        return self._run(a[0], a[1:], kw, lambda c: c.fetchall())
 
     def first(self, *a, **kw):
-        c = self.execute(*a, **kw)
-        res = c.fetchone()
-        c.close()
-        return res
+        def fetch(c):
+            res = c.fetchone()
+            c.close()
+            return res
+        return self._run(a[0], a[1:], kw, fetch)
 
     def list(self, *a, **kw):
-        return [x[0] for x in self.execute(*a, **kw)]
+        return self._run(a[0], a[1:], kw, lambda c: [x[0] for x in c])
+
+    def iter(self, *a, **kw):
+        """Yield the rows of a query, fetching BATCH rows at a time so memory
+use doesn't grow with the result. A commit or rollback before the iterator is
+exhausted will invalidate it."""
+        batch = kw.pop("batch", ITER_BATCH)
+        cur = self.execute(*a, **kw)
+        while 1:
+            rows = cur.fetchmany(batch)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+
+    # Profiling
+    ##########################################################################
+
+    def profile(self, on=True, **kw):
+        """Start collecting per-statement timings, returning the profiler.
+Keyword arguments are passed to Profiler. Call with ON=False to stop."""
+        if on:
+            if not self.profiler:
+                self.profiler = Profiler(**kw)
+        else:
+            self.profiler = None
+        self._updateTimed()
+        return self.profiler
+
+    def logSlow(self, threshold=100, keep=100):
+        """Log statements taking THRESHOLD ms or more, with their query plan.
+The last KEEP are kept in .slowQueries, and the slowQuery hook is run with
+each. Pass None to stop logging."""
+        self.slowThreshold = threshold
+        self._slowKeep = keep
+        self._updateTimed()
+
+    def _logSlow(self, sql, elapsed, args, caller):
+        plan = None
+        if args is not None:
+            try:
+                plan = self._explain(sql, args)
+            except sqlite.Error:
+                pass
+        if isinstance(args, dict):
+            args = dict(args)
+        elif args is not None:
+            args = list(args)
+        entry = dict(sql=sql, args=args, time=elapsed*1000, plan=plan,
+                     caller=caller)
+        self.slowQueries.append(entry)
+        del self.slowQueries[:-self._slowKeep]
+        runHook("slowQuery", entry)
+
+    def _explain(self, sql, args):
+        # python's sqlite module commits the open transaction before any
+        # statement it doesn't recognize, so explain on a second connection
+        if not self._explainDb:
+            self._explainDb = sqlite.connect(self._path, timeout=self._timeout)
+            addFunctions(self._explainDb)
+            self._initTemp(self._explainDb)
+        return [r[-1] for r in self._explainDb.execute(
+            "explain query plan " + sql, args)]
+
+    def _updateTimed(self):
+        self._timed = bool(self.echo or self.profiler or
+                           self.slowThreshold is not None)
+
+    # Write counts
+    ##########################################################################
+
+    def writeCount(self, table):
+        """A number that changes whenever TABLE may have been written to, so
+callers can tell if data they've cached from it is still current."""
+        return self._writes.get(table, 0) + self._resets
+
+    def _wrote(self, table):
+        self._writes[table] = self._writes.get(table, 0) + 1
+
+    # Write-behind queue
+    ##########################################################################
+
+    def writeBehind(self, size=WRITE_QUEUE):
+        """Queue writes made with defer() and run them together with
+executemany. The queue is flushed when SIZE writes are pending, before any
+statement that touches a table with queued writes, on commit and close, and
+by flushWrites(). Reads are not served from the queue, so only writes with no
+read of their tables in between are batched: a run of answers against
+prefetched cards is, but a getCard() that goes to the cards table ends the
+batch. Callers that want a batch to end at a known point should call
+flushWrites(). Pass size=None to turn it off."""
+        self.flushWrites()
+        self._wbSize = size
+
+    def defer(self, sql, *a):
+        "Run a write, or queue it if write-behind is on."
+        if not self._wbSize:
+            self.execute(sql, *a)
+            return
+        self._pending.append((sql, a))
+        table = self._classify(sql)[1]
+        self._pendingTables.add(table)
+        self._wrote(table)
+        self.mod = True
+        if len(self._pending) >= self._wbSize:
+            self.flushWrites()
+
+    def flushWrites(self):
+        "Run any queued writes, batching runs of the same statement."
+        if not self._pending:
+            return
+        pending = self._pending
+        self._pending = []
+        self._pendingTables = set()
+        # already counted by defer()
+        for sql, rows in itertools.groupby(pending, key=itemgetter(0)):
+            self._executemany(sql, [r[1] for r in rows])
+
+    def _touchesPending(self, sql):
+        try:
+            refs = self._refs[sql]
+        except KeyError:
+            refs = frozenset(re.findall(r"\w+", sql.lower()))
+            if len(sql) <= STMT_MAXLEN:
+                if len(self._refs) >= STMT_CACHE:
+                    self._refs.clear()
+                self._refs[sql] = refs
+        return not self._pendingTables.isdisjoint(refs)
+
+    # Id sets
+    ##########################################################################
+
+    def setQueryOnly(self):
+        "Have sqlite refuse any write from now on."
+        self.flushWrites()
+        self._db.commit()
+        self._db.execute("pragma query_only = 1")
+        # temp tables can't be written either, so id sets are inlined
+        self._haveIdSets = False
+
+    def setTempStore(self, store):
+        "Keep temp tables in STORE ('memory', 'file' or 'default')."
+        self._haveIdSets = self._initTemp(self._db, store)
+
+    def _initTemp(self, db, store="memory"):
+        "Create the id set table. False if the file can't be read."
+        # this must happen before any transaction is open, as python commits
+        # before DDL. changing temp_store later would drop the table.
+        db.execute("pragma temp_store = %s" % store)
+        try:
+            db.execute("""
+create temp table if not exists idsets (
+    sid             integer not null,
+    id              integer not null,
+    primary key (sid, id)
+)""")
+        except sqlite.DatabaseError:
+            # not a database; upgrade.check() opens such files
+            return False
+        return True
+
+    @contextmanager
+    def idSet(self, ids):
+        """Yield an SQL 'in' target for IDS, for use in place of ids2str().
+Large lists are bulk loaded into an indexed temp table, so the statement text
+stays the same whatever the number of ids. Sets may be nested."""
+        if not isinstance(ids, (list, tuple)):
+            ids = list(ids)
+        if len(ids) < IDSET_MIN or not self._haveIdSets:
+            yield ids2str(ids)
+            return
+        # use the raw connection so the collection isn't marked modified
+        sid = self._idSets
+        self._idSets += 1
+        try:
+            self._db.executemany(
+                "insert or ignore into temp.idsets values (%d, ?)" % sid,
+                ((x,) for x in ids))
+            yield "(select id from temp.idsets where sid = %d)" % sid
+        finally:
+            self._db.execute("delete from temp.idsets where sid = ?", (sid,))
+            self._idSets -= 1
+
+    # Bulk loading
+    ##########################################################################
+
+    @contextmanager
+    def bulk(self, dropIndices=False, cacheSize=BULK_CACHE):
+        """Speed up a large import or rewrite. Any open transaction is
+committed first; the work is then done as one transaction without fsyncs and
+with a larger page cache. If DROPINDICES, secondary indices are dropped and
+rebuilt at the end. The previous settings are restored on exit."""
+        self.commit()
+        old = []
+        for p in "synchronous", "cache_size", "journal_mode":
+            old.append((p, self.scalar("pragma %s" % p)))
+        self.execute("pragma synchronous = off")
+        self.execute("pragma cache_size = %d" % cacheSize)
+        # wal can't be changed while other connections are open, and doesn't
+        # journal the old pages anyway
+        if old[2][1].lower() != "wal":
+            self.execute("pragma journal_mode = memory")
+        indices = []
+        if dropIndices:
+            indices = self.all("""
+select name, sql from sqlite_master where type = 'index' and sql is not null""")
+            for name, sql in indices:
+                self.execute("drop index %s" % name)
+        try:
+            yield self
+        except:
+            self.rollback()
+            raise
+        else:
+            self.commit()
+        finally:
+            for name, sql in indices:
+                self.execute(sql)
+            for p, val in reversed(old):
+                self.execute("pragma %s = %s" % (p, val))
 
     def close(self):
+        # queued writes would otherwise be lost with the connection
+        if self._pending:
+            self.flushWrites()
+            self.commit()
         self._db.close()
+        if self._explainDb:
+            self._explainDb.close()
+            self._explainDb = None
 
     def set_progress_handler(self, *args):
         self._db.set_progress_handler(*args)
@@ -89,3 +457,206 @@ class DB(object):
 
     def __exit__(self, exc_type, *args):
         self._db.close()
+
+# SQL functions
+##########################################################################
+# Available on every connection, so notes can be filtered and updated
+# without pulling their fields into python.
+
+def _field(flds, ord):
+    "Field ORD of a note's FLDS, or an empty string if it has no such field."
+    if flds is None:
+        return None
+    flds = flds.split("\x1f")
+    if ord < len(flds):
+        return flds[ord]
+    return u""
+
+_regexps = {}
+
+def _regexp(pattern, s):
+    "Backs sqlite's 'S regexp PATTERN'. Patterns are compiled once."
+    if s is None:
+        return False
+    try:
+        r = _regexps[pattern]
+    except KeyError:
+        if len(_regexps) >= STMT_CACHE:
+            _regexps.clear()
+        r = _regexps[pattern] = re.compile(pattern)
+    return r.search(s) is not None
+
+def _stripHTML(s):
+    if s is None:
+        return None
+    return stripHTML(s)
+
+def _fieldChecksum(s):
+    if s is None:
+        return None
+    return fieldChecksum(s)
+
+def addFunctions(db):
+    "Register field(), stripHTML(), fieldChecksum() and regexp() on DB."
+    db.create_function("field", 2, _field)
+    db.create_function("stripHTML", 1, _stripHTML)
+    db.create_function("fieldChecksum", 1, _fieldChecksum)
+    db.create_function("regexp", 2, _regexp)
+
+# Read-only connection pool
+##########################################################################
+
+class ReadPool(object):
+    """Read-only connections to a WAL database, for use from worker threads.
+Each reader sees the last committed state of the database as of when it was
+checked out, while the main connection keeps writing."""
+
+    def __init__(self, path, size=READ_POOL, timeout=0):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._free = []
+        self._open = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def reader(self):
+        "Check out a connection, blocking if SIZE are already in use."
+        db = self._get()
+        try:
+            db.execute("begin")
+            try:
+                # the snapshot is taken on the first read
+                db.scalar("select count() from sqlite_master")
+                yield db
+            finally:
+                db.execute("rollback")
+        finally:
+            self._put(db)
+
+    def close(self):
+        "Close idle connections now, and busy ones when they're returned."
+        with self._cond:
+            self._closed = True
+            for db in self._free:
+                db.close()
+            self._open -= len(self._free)
+            self._free = []
+            self._cond.notify_all()
+
+    def _get(self):
+        with self._cond:
+            assert not self._closed
+            while not self._free and self._open >= self.size:
+                self._cond.wait()
+                assert not self._closed
+            if self._free:
+                return self._free.pop()
+            self._open += 1
+        try:
+            return DB(self.path, timeout=self.timeout, readOnly=True)
+        except:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+
+    def _put(self, db):
+        with self._cond:
+            if self._closed:
+                db.close()
+                self._open -= 1
+            else:
+                self._free.append(db)
+            self._cond.notify()
+
+# Profiling
+##########################################################################
+
+_numRe = re.compile(r"\b\d+\b")
+_strRe = re.compile(r"'(?:[^']|'')*'")
+_listRe = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_spaceRe = re.compile(r"\s+")
+
+def normalizeSQL(sql):
+    "Strip literals and whitespace from SQL so similar statements group."
+    sql = _strRe.sub("?", sql)
+    sql = _numRe.sub("?", sql)
+    # ids2str() lists collapse to a single placeholder
+    sql = _listRe.sub("(?)", sql)
+    return _spaceRe.sub(" ", sql).strip()
+
+def _caller():
+    "Name of the first function outside this module on the stack."
+    f = sys._getframe(1)
+    while f and f.f_globals.get("__name__") == __name__:
+        f = f.f_back
+    if not f:
+        return None
+    mod = f.f_globals.get("__name__", "?")
+    if mod.startswith("anki."):
+        mod = mod[5:]
+    obj = f.f_locals.get("self")
+    if obj is not None:
+        return "%s.%s.%s" % (mod, obj.__class__.__name__, f.f_code.co_name)
+    return "%s.%s" % (mod, f.f_code.co_name)
+
+class Profiler(object):
+    "Collects call count, timings, rows and callers per normalized statement."
+
+    def __init__(self, callers=5, samples=1000):
+        # number of callers to report, and timings kept for percentiles
+        self.callers = callers
+        self.samples = samples
+        self.reset()
+
+    def reset(self):
+        self._stats = {}
+
+    def record(self, sql, elapsed, rows=None, caller=None):
+        key = normalizeSQL(sql)
+        s = self._stats.get(key)
+        if not s:
+            s = self._stats[key] = dict(
+                count=0, total=0.0, max=0.0, rows=0, times=[], callers={})
+        s['count'] += 1
+        s['total'] += elapsed
+        s['max'] = max(s['max'], elapsed)
+        if rows:
+            s['rows'] += rows
+        # reservoir sample, so long sessions use bounded memory
+        if len(s['times']) < self.samples:
+            s['times'].append(elapsed)
+        else:
+            i = random.randrange(s['count'])
+            if i < self.samples:
+                s['times'][i] = elapsed
+        if caller:
+            s['callers'][caller] = s['callers'].get(caller, 0) + 1
+
+    def stats(self):
+        "A list of statement reports, most expensive first. Times are in ms."
+        ret = []
+        for sql, s in self._stats.items():
+            times = sorted(s['times'])
+            p95 = times[min(len(times)-1, int(len(times)*0.95))]
+            callers = sorted(s['callers'].items(), key=lambda x: -x[1])
+            ret.append(dict(
+                sql=sql,
+                count=s['count'],
+                total=s['total']*1000,
+                avg=s['total']*1000/s['count'],
+                p95=p95*1000,
+                max=s['max']*1000,
+                rows=s['rows'],
+                callers=callers[:self.callers]))
+        ret.sort(key=lambda x: -x['total'])
+        return ret
+
+    def dump(self, path=None):
+        "Return the stats as JSON, writing them to PATH if provided."
+        data = simplejson.dumps(self.stats(), indent=1)
+        if path:
+            open(path, "w").write(data)
+        return data
@@ -2,8 +2,9 @@
 # Copyright: Damien Elmes <anki@ichi2.net>
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
-import simplejson, copy
-from anki.utils import intTime, ids2str
+import copy
+from anki.utils import intTime, LazyJSON
+from anki.registry import ObjectTable
 from anki.consts import *
 from anki.lang import _
 from anki.errors import DeckRenameError
@@ -63,6 +64,10 @@ defaultConf = {
 
 class DeckManager(object):
 
+    # parsed on first use
+    decks = LazyJSON("decks")
+    dconf = LazyJSON("dconf")
+
     # Registry save/load
     #############################################################
 
@@ -70,24 +75,62 @@ class DeckManager(object):
         self.col = col
 
     def load(self, decks, dconf):
-        self.decks = simplejson.loads(decks)
-        self.dconf = simplejson.loads(dconf)
+        "Load from JSON, or from the decks and dconf tables if it's empty."
+        if decks:
+            self.tables = None
+            self.decks = decks
+            self.dconf = dconf
+        else:
+            self.tables = (ObjectTable(self.col, "decks"),
+                           ObjectTable(self.col, "dconf"))
+            self.decks = self.tables[0].load
+            self.dconf = self.tables[1].load
         self.changed = False
 
+    def useTables(self):
+        "Move the registries into the decks and dconf tables on next flush."
+        self.tables = (ObjectTable(self.col, "decks"),
+                       ObjectTable(self.col, "dconf"))
+        for t in self.tables:
+            t.mark()
+        self.changed = True
+
     def save(self, g=None):
         "Can be called with either a deck or a deck configuration."
         if g:
             g['mod'] = intTime()
             g['usn'] = self.col.usn()
+        if self.tables:
+            # ids may be in both; only changed objects are written
+            for t in self.tables:
+                t.mark(g['id'] if g else None)
         self.changed = True
 
     def flush(self):
         if self.changed:
-            self.col.db.execute("update col set decks=?, dconf=?",
-                                 simplejson.dumps(self.decks),
-                                 simplejson.dumps(self.dconf))
+            if self.tables:
+                self.tables[0].flush(self.decks)
+                self.tables[1].flush(self.dconf)
+            else:
+                self.col.db.execute("update col set decks=?, dconf=?",
+                                     DeckManager.decks.dumps(self),
+                                     DeckManager.dconf.dumps(self))
             self.changed = False
 
+    def since(self, usn):
+        """Decks and configs with a usn of USN or later, as a pair of lists.
+-1 selects those not yet synced."""
+        if self.tables:
+            return [[self.decks[id] for id in self.tables[0].since(
+                        usn, self.decks, self.changed)],
+                    [self.dconf[id] for id in self.tables[1].since(
+                        usn, self.dconf, self.changed)]]
+        if usn == -1:
+            match = lambda g: g['usn'] == -1
+        else:
+            match = lambda g: g['usn'] >= usn
+        return [filter(match, self.all()), filter(match, self.allConf())]
+
     # Deck save/load
     #############################################################
 
@@ -104,10 +147,7 @@ class DeckManager(object):
             # not top level; ensure all parents exist
             self._ensureParents(name)
         g['name'] = name
-        while 1:
-            id = intTime(1000)
-            if str(id) not in self.decks:
-                break
+        id = self.col.ids.next("decks", self.decks.keys())
         g['id'] = id
         self.decks[str(id)] = g
         self.save(g)
@@ -235,10 +275,7 @@ class DeckManager(object):
     def confId(self, name, cloneFrom=defaultConf):
         "Create a new configuration and return id."
         c = copy.deepcopy(cloneFrom)
-        while 1:
-            id = intTime(1000)
-            if str(id) not in self.dconf:
-                break
+        id = self.col.ids.next("dconf", self.dconf.keys())
         c['id'] = id
         c['name'] = name
         self.dconf[str(id)] = c
@@ -284,9 +321,11 @@ class DeckManager(object):
         return self.get(did)['name']
 
     def setDeck(self, cids, did):
-        self.col.db.execute(
-            "update cards set did=?,usn=?,mod=? where id in "+
-            ids2str(cids), did, self.col.usn(), intTime())
+        with self.col.sched.cardsChanging(cids):
+            with self.col.db.idSet(cids) as scids:
+                self.col.db.execute(
+                    "update cards set did=?,usn=?,mod=? where id in "+
+                    scids, did, self.col.usn(), intTime())
 
     def maybeAddToActive(self):
         # reselect current deck, or default if current has disappeared
@@ -8,7 +8,7 @@ from operator import itemgetter
 from anki.cards import Card
 from anki.sync import SyncClient, SyncServer, copyLocalMedia
 from anki.lang import _
-from anki.utils import parseTags, stripHTML, ids2str
+from anki.utils import parseTags, stripHTML
 
 class Exporter(object):
     def __init__(self, col):
@@ -48,9 +48,9 @@ class Exporter(object):
             cards = self.col.db.column0("select id from cards")
         else:
             d = tagIds(self.col.db, self.limitTags, create=False)
-            cards = self.col.db.column0(
-                "select cardId from cardTags where tagid in %s" %
-                ids2str(d.values()))
+            with self.col.db.idSet(d.values()) as sids:
+                cards = self.col.db.column0(
+                    "select cardId from cardTags where tagid in %s" % sids)
         self.count = len(cards)
         return cards
 
@@ -100,18 +100,19 @@ class AnkiExporter(Exporter):
 
     def localSummary(self):
         cardIds = self.cardIds()
-        cStrIds = ids2str(cardIds)
-        cards = self.deck.db.all("""
+        with self.deck.db.idSet(cardIds) as cStrIds:
+            cards = self.deck.db.all("""
 select id, modified from cards
 where id in %s""" % cStrIds)
-        notes = self.deck.db.all("""
+            notes = self.deck.db.all("""
 select notes.id, notes.modified from cards, notes where
 notes.id = cards.noteId and
 cards.id in %s""" % cStrIds)
-        models = self.deck.db.all("""
+        with self.deck.db.idSet([f[0] for f in notes]) as sids:
+            models = self.deck.db.all("""
 select models.id, models.modified from models, notes where
 notes.modelId = models.id and
-notes.id in %s""" % ids2str([f[0] for f in notes]))
+notes.id in %s""" % sids)
         media = self.deck.db.all("""
 select id, modified from media""")
         return {
@@ -140,13 +141,13 @@ class TextCardExporter(Exporter):
 
     def doExport(self, file):
         ids = self.cardIds()
-        strids = ids2str(ids)
-        cards = self.deck.db.all("""
+        with self.deck.db.idSet(ids) as strids:
+            cards = self.deck.db.all("""
 select cards.question, cards.answer, cards.id from cards
 where cards.id in %s
 order by cards.created""" % strids)
-        if self.includeTags:
-            self.cardTags = dict(self.deck.db.all("""
+            if self.includeTags:
+                self.cardTags = dict(self.deck.db.all("""
 select cards.id, notes.tags from cards, notes
 where cards.noteId = notes.id
 and cards.id in %s
@@ -177,19 +178,20 @@ class TextNoteExporter(Exporter):
 
     def doExport(self, file):
         cardIds = self.cardIds()
-        notes = self.deck.db.all("""
+        with self.deck.db.idSet(cardIds) as sids:
+            notes = self.deck.db.all("""
 select noteId, value, notes.created from notes, fields
 where
 notes.id in
 (select distinct noteId from cards
 where cards.id in %s)
 and notes.id = fields.noteId
-order by noteId, ordinal""" % ids2str(cardIds))
+order by noteId, ordinal""" % sids)
         txt = ""
         if self.includeTags:
-            self.noteTags = dict(self.deck.db.all(
-                "select id, tags from notes where id in %s" %
-                ids2str([note[0] for note in notes])))
+            with self.deck.db.idSet([note[0] for note in notes]) as sids:
+                self.noteTags = dict(self.deck.db.all(
+                    "select id, tags from notes where id in %s" % sids))
         groups = itertools.groupby(notes, itemgetter(0))
         groups = [[x for x in y[1]] for y in groups]
         groups = [(group[0][2],
@@ -34,8 +34,10 @@ def fieldNames(col, downcase=True):
 
 class Finder(object):
 
-    def __init__(self, col):
+    def __init__(self, col, db=None):
         self.col = col
+        # a pool connection when searching from another thread
+        self.db = db or col.db
 
     def findCards(self, query, full=False):
         "Return a list of card ids for QUERY."
@@ -49,7 +51,7 @@ class Finder(object):
         query = """\
 select c.id from cards c, notes n where %s
 and c.nid=n.id %s""" % (q, order)
-        res = self.col.db.list(query, **args)
+        res = self.db.list(query, **args)
         if self.col.conf['sortBackwards']:
             res.reverse()
         return res
@@ -109,7 +111,7 @@ and c.nid=n.id %s""" % (q, order)
             elif type == SEARCH_TEMPLATE:
                 self._findTemplate(token, isNeg)
             elif type == SEARCH_FIELD:
-                self._findField(token, isNeg)
+                self._findField(token, isNeg, c)
             elif type == SEARCH_MODEL:
                 self._findModel(token, isNeg)
             elif type == SEARCH_DECK:
@@ -163,14 +165,11 @@ and c.nid=n.id %s""" % (q, order)
 (sfld %s like :_text_%d escape '\\' or
 flds %s like :_text_%d escape '\\')""" % (extra, c, extra, c))
         else:
-            # in the future we may want to apply this at the end to speed up
-            # the case where there are other limits
-            nids = []
-            for nid, flds in self.col.db.execute(
-                "select id, flds from notes"):
-                if val in stripHTML(flds):
-                    nids.append(nid)
-            self.lims['preds'].append("n.id in " + ids2str(nids))
+            # html is stripped by sqlite as it checks each note
+            self.lims['args']["_text_%d"%c] = re.escape(val).replace(
+                "\\%", ".*")
+            self.lims['preds'].append(
+                "stripHTML(n.flds) %s regexp :_text_%d" % (extra, c))
 
     def _findNids(self, val):
         self.lims['preds'].append("n.id in (%s)" % val)
@@ -217,7 +216,7 @@ flds %s like :_text_%d escape '\\')""" % (extra, c, extra, c))
             self.lims['preds'].append("(" + " or ".join(lims) + ")")
         self.lims['valid'] = found
 
-    def _findField(self, token, isNeg):
+    def _findField(self, token, isNeg, c):
         field = value = ''
         parts = token.split(':', 1);
         field = parts[0].lower()
@@ -232,23 +231,23 @@ flds %s like :_text_%d escape '\\')""" % (extra, c, extra, c))
             # nothing has that field
             self.lims['valid'] = False
             return
-        # gather nids
-        regex = value.replace("%", ".*")
-        nids = []
-        for (id,mid,flds) in self.col.db.execute("""
-select id, mid, flds from notes
-where mid in %s and flds like ? escape '\\'""" % (
-                         ids2str(mods.keys())),
-                         "%" if self.full else value):
-            flds = splitFields(flds)
-            ord = mods[str(mid)][1]
-            strg = flds[ord]
+        # match the field inside sqlite
+        self.lims['args']["_field_%d"%c] = value.replace("%", ".*")
+        lims = []
+        for mid, (m, ord) in mods.items():
+            fld = "field(n.flds, %d)" % ord
             if self.full:
-                strg = stripHTML(strg)
-            if re.search(regex, strg):
-                nids.append(id)
+                fld = "stripHTML(%s)" % fld
+            lims.append("(n.mid = %s and %s regexp :_field_%d)" % (
+                mid, fld, c))
+        pred = " or ".join(lims)
+        if not self.full:
+            # a cheap check of all the fields rules out most notes first
+            self.lims['args']["_fieldlike_%d"%c] = value
+            pred = "n.flds like :_fieldlike_%d escape '\\' and (%s)" % (
+                c, pred)
         extra = "not" if isNeg else ""
-        self.lims['preds'].append("n.id %s in %s" % (extra, ids2str(nids)))
+        self.lims['preds'].append("%s (%s)" % (extra, pred))
 
     # Most of this function was written by Marcus
     def _parseQuery(self):
@@ -384,21 +383,32 @@ def findReplace(col, nids, src, dst, regex=False, field=None, fold=True):
     regex = re.compile(src)
     def repl(str):
         return re.sub(regex, dst, str)
+    # only notes with a match are returned
+    if field:
+        lims = ["(mid = %s and field(flds, %d) regexp :re)" % (mid, ord)
+                for mid, ord in mmap.items()]
+    else:
+        lims = []
+        for m in col.models.all():
+            lims.append("(mid = %s and (%s))" % (m['id'], " or ".join(
+                "field(flds, %d) regexp :re" % f['ord'] for f in m['flds'])))
     d = []
-    for nid, mid, flds in col.db.execute(
-        "select id, mid, flds from notes where id in "+ids2str(nids)):
-        origFlds = flds
-        # does it match?
-        sflds = splitFields(flds)
-        if field:
-            ord = mmap[str(mid)]
-            sflds[ord] = repl(sflds[ord])
-        else:
-            for c in range(len(sflds)):
-                sflds[c] = repl(sflds[c])
-        flds = joinFields(sflds)
-        if flds != origFlds:
-            d.append(dict(nid=nid,flds=flds,u=col.usn(),m=intTime()))
+    with col.db.idSet(nids) as snids:
+        for nid, mid, flds in col.db.execute(
+            "select id, mid, flds from notes where id in %s and (%s)" % (
+                snids, " or ".join(lims) or "0"), re=src):
+            origFlds = flds
+            # does it match?
+            sflds = splitFields(flds)
+            if field:
+                ord = mmap[str(mid)]
+                sflds[ord] = repl(sflds[ord])
+            else:
+                for c in range(len(sflds)):
+                    sflds[c] = repl(sflds[c])
+            flds = joinFields(sflds)
+            if flds != origFlds:
+                d.append(dict(nid=nid,flds=flds,u=col.usn(),m=intTime()))
     if not d:
         return 0
     # replace
@@ -5,6 +5,7 @@
 from anki import Collection
 from anki.utils import intTime
 from anki.importing.base import Importer
+from anki.db import ITER_BATCH
 from anki.lang import _
 
 #
@@ -45,12 +46,21 @@ class Anki2Importer(Importer):
             self.dst.decks.select(id)
         self._prepareTS()
         self._prepareModels()
-        self._importNotes()
-        self._importCards()
+        # when the import is larger than the collection, it's cheaper to
+        # rebuild the indices afterwards than to maintain them
+        drop = self.src.noteCount() > self.dst.noteCount()
+        with self.dst.bulk(dropIndices=drop):
+            self._importNotes()
+            self._importCards()
+        self._prepareTS()
         self._importMedia()
         self._postImport()
-        self.dst.db.execute("vacuum")
-        self.dst.db.execute("analyze")
+        if self.dst.db.scalar("pragma auto_vacuum") == 2:
+            self.dst.maintain()
+        else:
+            # collections made before incremental vacuum are moved to it by
+            # a full vacuum, once
+            self.dst.optimize()
 
     # Notes
     ######################################################################
@@ -68,7 +78,7 @@ class Anki2Importer(Importer):
         add = []
         dirty = []
         usn = self.dst.usn()
-        for note in self.src.db.execute(
+        for note in self.src.db.iter(
             "select * from notes"):
             # turn the db result into a mutable list
             note = list(note)
@@ -93,7 +103,16 @@ class Anki2Importer(Importer):
             else:
                 # not yet implemented
                 pass
-        # add to col
+            # write out in batches so memory use stays flat
+            if len(add) >= ITER_BATCH:
+                self._addNotes(add, dirty)
+                add = []
+                dirty = []
+        self._addNotes(add, dirty)
+
+    def _addNotes(self, add, dirty):
+        if not add:
+            return
         self.dst.db.executemany(
             "insert or replace into notes values (?,?,?,?,?,?,?,?,?,?,?,?)",
             add)
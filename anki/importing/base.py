@@ -2,7 +2,7 @@
 # Copyright: Damien Elmes <anki@ichi2.net>
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
-from anki.utils import intTime, maxID
+from anki.utils import intTime
 
 # Base importer
 ##########################################################################
@@ -22,13 +22,8 @@ class Importer(object):
 
     # Timestamps
     ######################################################################
-    # It's too inefficient to check for existing ids on every object,
-    # and a previous import may have created timestamps in the future, so we
-    # need to make sure our starting point is safe.
+    # A previous import may have created timestamps in the future, so the
+    # collection's id allocator is reseeded before and after importing.
 
     def _prepareTS(self):
-        self._ts = maxID(self.dst.db)
-
-    def ts(self):
-        self._ts += 1
-        return self._ts
+        self.dst.ids.reset()
@@ -4,7 +4,7 @@
 
 import time
 from anki.lang import _
-from anki.utils import fieldChecksum, ids2str
+from anki.utils import fieldChecksum
 from anki.errors import *
 from anki.importing.base import Importer
 #from anki.deck import NEW_CARDS_RANDOM
@@ -113,9 +113,9 @@ and fieldModelId = :fmid""", data)
                 "update notes set tags = :t where id = :nid",
                 data)
         # rebuild caches
-        cids = self.col.db.column0(
-            "select id from cards where noteId in %s" %
-            ids2str(nids))
+        with self.col.db.idSet(nids) as snids:
+            cids = self.col.db.column0(
+                "select id from cards where noteId in %s" % snids)
         self.col.updateCardTags(cids)
         self.col.updateCardsFromNoteIds(nids)
         self.total = len(cards)
@@ -160,7 +160,7 @@ If the same name exists, compare checksums."""
     def allMedia(self):
         "Return a set of all referenced filenames."
         files = set()
-        for mid, flds in self.col.db.execute("select mid, flds from notes"):
+        for mid, flds in self.col.db.iter("select mid, flds from notes"):
             for f in self.filesInStr(mid, flds):
                 files.add(f)
         return files
@@ -2,12 +2,16 @@
 # Copyright: Damien Elmes <anki@ichi2.net>
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
-import simplejson, copy, re
-from anki.utils import intTime, hexifyID, joinFields, splitFields, ids2str, \
-    timestampID, fieldChecksum
+import copy, re
+from anki.utils import intTime, hexifyID, joinFields, splitFields, \
+    fieldChecksum, LazyJSON
+from anki.registry import ObjectTable
 from anki.lang import _
 from anki.consts import *
 
+# cloze numbers used in a note, as required by cloze templates
+clozeNumRe = re.compile(r"\{\{c(\d+)::")
+
 # Models
 ##########################################################################
 
@@ -62,16 +66,34 @@ defaultTemplate = {
 
 class ModelManager(object):
 
+    # parsed on first use
+    models = LazyJSON("models")
+
     # Saving/loading registry
     #############################################################
 
     def __init__(self, col):
         self.col = col
+        # mid -> (m['req'], compiled requirements)
+        self._reqCache = {}
+        # calls to save(), so cached renders can tell a model may have changed
+        self.saves = 0
 
     def load(self, json):
-        "Load registry from JSON."
+        "Load registry from JSON, or from the models table if JSON is empty."
         self.changed = False
-        self.models = simplejson.loads(json)
+        if json:
+            self.table = None
+            self.models = json
+        else:
+            self.table = ObjectTable(self.col, "models")
+            self.models = self.table.load
+
+    def useTable(self):
+        "Move the registry into the models table on the next flush."
+        self.table = ObjectTable(self.col, "models")
+        self.table.mark()
+        self.changed = True
 
     def save(self, m=None, templates=False):
         "Mark M modified if provided, and schedule registry flush."
@@ -81,15 +103,30 @@ class ModelManager(object):
             self._updateRequired(m)
             if templates:
                 self._syncTemplates(m)
+        if self.table:
+            self.table.mark(m['id'] if m and m['id'] else None)
         self.changed = True
+        self.saves += 1
 
     def flush(self):
         "Flush the registry if any models were changed."
         if self.changed:
-            self.col.db.execute("update col set models = ?",
-                                 simplejson.dumps(self.models))
+            if self.table:
+                self.table.flush(self.models)
+            else:
+                self.col.db.execute("update col set models = ?",
+                                     ModelManager.models.dumps(self))
             self.changed = False
 
+    def since(self, usn):
+        "Models with a usn of USN or later. -1 selects those not yet synced."
+        if self.table:
+            return [self.models[id] for id in self.table.since(
+                usn, self.models, self.changed)]
+        if usn == -1:
+            return [m for m in self.all() if m['usn'] == -1]
+        return [m for m in self.all() if m['usn'] >= usn]
+
     # Retrieving and creating models
     #############################################################
 
@@ -158,11 +195,7 @@ select id from cards where nid in (select id from notes where mid = ?)""",
         self.save()
 
     def _setID(self, m):
-        while 1:
-            id = str(intTime(1000))
-            if id not in self.models:
-                break
-        m['id'] = id
+        m['id'] = str(self.col.ids.next("models", self.models.keys()))
 
     def have(self, id):
         return str(id) in self.models
@@ -314,12 +347,14 @@ select c.id from cards c, notes f where c.nid=f.id and mid = ? and ord = ?""",
                                  m['id'], ord)
         # all notes with this template must have at least two cards, or we
         # could end up creating orphaned notes
-        if self.col.db.scalar("""
+        with self.col.db.idSet(cids) as scids:
+            orphans = self.col.db.scalar("""
 select nid, count() from cards where
 nid in (select nid from cards where id in %s)
 group by nid
 having count() < 2
-limit 1""" % ids2str(cids)):
+limit 1""" % scids)
+        if orphans:
             return False
         # ok to proceed; remove cards
         self.col.modSchema()
@@ -377,18 +412,19 @@ select id from notes where mid = ?)""" % " ".join(map),
     def _changeNotes(self, nids, newModel, map):
         d = []
         nfields = len(newModel['flds'])
-        for (nid, flds) in self.col.db.execute(
-            "select id, flds from notes where id in "+ids2str(nids)):
-            newflds = {}
-            flds = splitFields(flds)
-            for old, new in map.items():
-                newflds[new] = flds[old]
-            flds = []
-            for c in range(nfields):
-                flds.append(newflds.get(c, ""))
-            flds = joinFields(flds)
-            d.append(dict(nid=nid, flds=flds, mid=newModel['id'],
-                      m=intTime(),u=self.col.usn()))
+        with self.col.db.idSet(nids) as snids:
+            for (nid, flds) in self.col.db.execute(
+                "select id, flds from notes where id in "+snids):
+                newflds = {}
+                flds = splitFields(flds)
+                for old, new in map.items():
+                    newflds[new] = flds[old]
+                flds = []
+                for c in range(nfields):
+                    flds.append(newflds.get(c, ""))
+                flds = joinFields(flds)
+                d.append(dict(nid=nid, flds=flds, mid=newModel['id'],
+                          m=intTime(),u=self.col.usn()))
         self.col.db.executemany(
             "update notes set flds=:flds,mid=:mid,mod=:m,usn=:u where id = :nid", d)
         self.col.updateFieldCache(nids)
@@ -396,13 +432,14 @@ select id from notes where mid = ?)""" % " ".join(map),
     def _changeCards(self, nids, newModel, map):
         d = []
         deleted = []
-        for (cid, ord) in self.col.db.execute(
-            "select id, ord from cards where nid in "+ids2str(nids)):
-            if map[ord] is not None:
-                d.append(dict(
-                    cid=cid,new=map[ord],u=self.col.usn(),m=intTime()))
-            else:
-                deleted.append(cid)
+        with self.col.db.idSet(nids) as snids:
+            for (cid, ord) in self.col.db.execute(
+                "select id, ord from cards where nid in "+snids):
+                if map[ord] is not None:
+                    d.append(dict(
+                        cid=cid,new=map[ord],u=self.col.usn(),m=intTime()))
+                else:
+                    deleted.append(cid)
         self.col.db.executemany(
             "update cards set ord=:new,usn=:u,mod=:m where id=:cid",
             d)
@@ -484,45 +521,50 @@ select id from notes where mid = ?)""" % " ".join(map),
 
     def availOrds(self, m, flds):
         "Given a joined field string, return available template ordinals."
-        fields = {}
+        # bit n is set if field n is non-empty
+        filled = 0
         for c, f in enumerate(splitFields(flds)):
-            fields[c] = f.strip()
+            if f.strip():
+                filled |= 1 << c
+        clozes = None
         avail = []
-        for ord, type, req, reqstrs in m['req']:
+        for ord, type, mask, nums in self._compiledReq(m):
             # unsatisfiable template
             if type == "none":
                 continue
             # AND requirement?
             elif type == "all":
-                ok = True
-                for idx in req:
-                    if not fields[idx]:
-                        # missing and was required
-                        ok = False
-                        break
-                if not ok:
+                if filled & mask != mask:
                     continue
             # OR requirement?
             elif type == "any":
-                ok = False
-                for idx in req:
-                    if fields[idx]:
-                        ok = True
-                        break
-                if not ok:
+                if not filled & mask:
                     continue
             # extra cloze requirement?
-            ok = True
-            for s in reqstrs:
-                if s not in flds:
-                    # required cloze string was missing
-                    ok = False
-                    break
-            if not ok:
-                continue
+            if nums:
+                if clozes is None:
+                    clozes = set(int(n) for n in clozeNumRe.findall(flds))
+                if not nums <= clozes:
+                    continue
             avail.append(ord)
         return avail
 
+    def _compiledReq(self, m):
+        "M's requirements as (ord, type, field bitmask, cloze numbers)."
+        cached = self._reqCache.get(m['id'])
+        if cached and cached[0] is m['req']:
+            return cached[1]
+        comp = []
+        for ord, type, req, reqstrs in m['req']:
+            mask = 0
+            for idx in req:
+                mask |= 1 << idx
+            nums = frozenset(int(clozeNumRe.match(s).group(1))
+                             for s in reqstrs)
+            comp.append((ord, type, mask, nums))
+        self._reqCache[m['id']] = (m['req'], comp)
+        return comp
+
     # Sync handling
     ##########################################################################
 
@@ -5,18 +5,19 @@
 import time
 from anki.errors import AnkiError
 from anki.utils import fieldChecksum, intTime, \
-    joinFields, splitFields, ids2str, stripHTML, timestampID, guid64
+    joinFields, splitFields, ids2str, stripHTML, guid64
 
 class Note(object):
 
-    def __init__(self, col, model=None, id=None):
+    def __init__(self, col, model=None, id=None, row=None):
+        "ROW can be passed with ID if the note has already been read."
         assert not (model and id)
         self.col = col
         if id:
             self.id = id
-            self.load()
+            self.load(row)
         else:
-            self.id = timestampID(col.db, "notes")
+            self.id = col.ids.next("notes")
             self.guid = guid64()
             self._model = model
             self.did = model['did']
@@ -28,7 +29,7 @@ class Note(object):
             self._fmap = self.col.models.fieldMap(self._model)
             self.scm = self.col.scm
 
-    def load(self):
+    def load(self, row=None):
         (self.guid,
          self.mid,
          self.did,
@@ -37,7 +38,7 @@ class Note(object):
          self.tags,
          self.fields,
          self.flags,
-         self.data) = self.col.db.first("""
+         self.data) = row or self.col.db.first("""
 select guid, mid, did, mod, usn, tags, flds, flags, data
 from notes where id = ?""", self.id)
         self.fields = splitFields(self.fields)
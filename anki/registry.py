@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+# Copyright: Damien Elmes <anki@ichi2.net>
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+import simplejson
+
+"""
+The model, deck, deck configuration and tag registries are normally stored as
+JSON in the col table, and the whole registry is rewritten when anything in
+it changes. A collection can instead store them as a row per object, with its
+own mod and usn. Saving then writes only the objects that changed, and sync
+can find changes by usn with an index.
+
+A collection using the tables has empty registry columns in col. As those
+are written in the same transaction as the rows, the managers can check them
+on load to pick the mode. See _Collection.useRegistryTables().
+"""
+
+def addTables(db):
+    db.executescript("""
+create table if not exists models (
+    id              integer primary key,
+    mod             integer not null,
+    usn             integer not null,
+    data            text not null
+);
+create table if not exists decks (
+    id              integer primary key,
+    mod             integer not null,
+    usn             integer not null,
+    data            text not null
+);
+create table if not exists dconf (
+    id              integer primary key,
+    mod             integer not null,
+    usn             integer not null,
+    data            text not null
+);
+create table if not exists tags (
+    tag             text not null primary key,
+    usn             integer not null
+);
+create index if not exists ix_models_usn on models (usn);
+create index if not exists ix_decks_usn on decks (usn);
+create index if not exists ix_dconf_usn on dconf (usn);
+create index if not exists ix_tags_usn on tags (usn);
+""")
+
+class ObjectTable(object):
+    "A registry of JSON objects keyed by id, stored as a row per object."
+
+    # registries are keyed by string ids in memory, and integers on disk
+    _column = "id"
+
+    def __init__(self, col, table):
+        # the collection's db is read each time, as it's replaced on reopen
+        self.col = col
+        self.table = table
+        # json of each object as last read or written
+        self._saved = {}
+        self._dirty = set()
+        self._all = False
+
+    @property
+    def db(self):
+        return self.col.db
+
+    def load(self, db=None):
+        """Return the registry as a dict keyed by string id. DB can be given
+to read from another connection."""
+        objs = {}
+        self._saved = {}
+        for id, data in (db or self.db).execute(
+            "select id, data from %s" % self.table):
+            objs[str(id)] = simplejson.loads(data)
+            self._saved[str(id)] = data
+        return objs
+
+    def mark(self, id=None):
+        "Note that object ID has changed, or any of them if ID is None."
+        if id is None:
+            self._all = True
+        else:
+            self._dirty.add(self._key(id))
+
+    def flush(self, objs):
+        """Write the marked objects in OBJS that have changed. If none are
+marked, the registry was changed without saying which, so all are checked."""
+        if self._all or not self._dirty:
+            ids = set(objs.keys()) | set(self._saved.keys())
+        else:
+            ids = self._dirty
+        rows = []
+        gone = []
+        for id in ids:
+            if id not in objs:
+                if id in self._saved:
+                    gone.append((self._dbKey(id),))
+                    del self._saved[id]
+                continue
+            data = self._dumps(objs[id])
+            if self._saved.get(id) != data:
+                rows.append(self._row(id, objs[id], data))
+                self._saved[id] = data
+        if rows:
+            self.db.executemany(self._insertSQL(), rows)
+        if gone:
+            self.db.executemany(
+                "delete from %s where %s = ?" % (self.table, self._column),
+                gone)
+        self._dirty = set()
+        self._all = False
+
+    def since(self, usn, objs, changed=False):
+        """Ids in OBJS with a usn of USN or later. -1 selects those not yet
+synced. Rows are found by usn, along with any objects not yet flushed, which
+is all of them if the registry is CHANGED without marks."""
+        op = "=" if usn == -1 else ">="
+        ids = set(self._key(k) for k in self.db.list(
+            "select %s from %s where usn %s ?" % (self._column, self.table, op),
+            usn))
+        if self._all or (changed and not self._dirty):
+            ids.update(objs)
+        else:
+            ids.update(self._dirty)
+        if usn == -1:
+            match = lambda u: u == -1
+        else:
+            match = lambda u: u >= usn
+        return sorted(id for id in ids
+                      if id in objs and match(self._usn(objs[id])))
+
+    def _key(self, id):
+        return str(id)
+
+    def _dbKey(self, id):
+        return int(id)
+
+    def _dumps(self, obj):
+        return simplejson.dumps(obj)
+
+    def _usn(self, obj):
+        return obj['usn']
+
+    def _row(self, id, obj, data):
+        return (int(id), obj.get('mod', 0), obj.get('usn', 0), data)
+
+    def _insertSQL(self):
+        return "insert or replace into %s values (?,?,?,?)" % self.table
+
+class TagTable(ObjectTable):
+    "The tag registry, a row per tag holding its usn."
+
+    _column = "tag"
+
+    def __init__(self, col):
+        ObjectTable.__init__(self, col, "tags")
+
+    def load(self, db=None):
+        tags = {}
+        for tag, usn in (db or self.db).execute("select tag, usn from tags"):
+            tags[tag] = usn
+        self._saved = tags.copy()
+        return tags
+
+    def _key(self, tag):
+        return tag
+
+    def _dbKey(self, tag):
+        return tag
+
+    def _dumps(self, usn):
+        return usn
+
+    def _usn(self, usn):
+        return usn
+
+    def _row(self, tag, usn, data):
+        return (tag, usn)
+
+    def _insertSQL(self):
+        return "insert or replace into tags values (?,?)"
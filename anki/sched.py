@@ -4,12 +4,21 @@
 
 import time, datetime, simplejson, random, itertools, math
 from operator import itemgetter
+from contextlib import contextmanager
 from heapq import *
 #from anki.cards import Card
 from anki.utils import ids2str, intTime, fmtTimeSpan
 from anki.lang import _, ngettext
 from anki.consts import *
 from anki.hooks import runHook
+import anki.cards, anki.notes
+
+# cards kept loaded and rendered ahead of the review
+PREFETCH = 5
+
+# per-deck queries combined into a statement when filling the queues. sqlite
+# allows at most 500.
+QUEUE_UNION = 400
 
 # revlog:
 # types: 0=lrn, 1=rev, 2=relrn, 3=cram
@@ -24,11 +33,20 @@ class Scheduler(object):
         self.reportLimit = 1000
         # fixme: replace reps with deck based counts
         self.reps = 0
+        self._totals = None
+        self.prefetch = PREFETCH
+        self._prefetched = {}
+        self._prefetchVer = None
+        # set while answerCards() applies a batch
+        self._batch = None
         self._updateCutoff()
 
     def getCard(self):
         "Pop the next card from the queue. None if finished."
         self._checkDay()
+        if self.prefetch and not (
+            self._prefetched and self._prefetchCurrent()):
+            self.prefetchCards()
         card = self._getCard()
         if card:
             card.startTimer()
@@ -36,6 +54,8 @@ class Scheduler(object):
 
     def reset(self):
         self._updateCutoff()
+        self._prefetched = {}
+        self._prefetchVer = None
         self._resetLrn()
         self._resetRev()
         self._resetNew()
@@ -43,6 +63,85 @@ class Scheduler(object):
     def answerCard(self, card, ease):
         assert ease >= 1 and ease <= 4
         self.col.markReview(card)
+        old = (card.did, card.queue, card.due)
+        writes = self.col.db.writeCount("cards")
+        fetched = self._prefetchCurrent()
+        self._answerCard(card, ease)
+        card.mod = intTime()
+        card.usn = self.col.usn()
+        card.flushSched()
+        # if nothing but this card was written, adjust the due totals
+        if (self._totalsCurrent(writes) and
+            self.col.db.writeCount("cards") == writes + 1):
+            self._addTotal(-1, *old)
+            self._addTotal(1, card.did, card.queue, card.due)
+            self._totalsVer = writes + 1
+        # and the other prefetched cards are still current
+        self._prefetched.pop(card.id, None)
+        if fetched:
+            self._prefetchKeep(writes + 1)
+
+    def answerCards(self, answers):
+        """Apply ANSWERS, a list of (cid, ease, timeTaken, answeredAt) as sent
+by clients, in order. TimeTaken is in milliseconds and answeredAt in seconds.
+Each card is scheduled from the day it was answered. The cards are written
+and the deck stats saved once for the batch, and the queues are reset
+afterwards. Nothing is written if an answer can't be applied."""
+        for cid, ease, taken, at in answers:
+            assert ease >= 1 and ease <= 4
+        cards = {}
+        ids = set(a[0] for a in answers)
+        with self.col.db.idSet(ids) as sids:
+            for row in self.col.db.execute(
+                "select * from cards where id in " + sids):
+                cards[row[0]] = anki.cards.Card(self.col, row[0], row)
+        if len(cards) != len(ids):
+            raise Exception("Unknown card ids: %s" % ", ".join(
+                str(id) for id in sorted(ids - set(cards))))
+        states = []
+        self._batch = dict(revlog=[], stats={}, leeches=[])
+        today = self.today
+        reps = self.reps
+        try:
+            for cid, ease, taken, at in answers:
+                card = cards[cid]
+                states.append((card, self.col.reviewState(card)))
+                self._batch['at'] = at
+                self._batch['taken'] = min(
+                    taken, card.deckConf()['maxTaken']*1000)
+                self.today = int((at - self.col.crt) / 86400)
+                self._answerCard(card, ease)
+            batch = self._batch
+        except:
+            # the queues and counts may have been changed
+            self.reps = reps
+            self.today = today
+            self.reset()
+            raise
+        finally:
+            self._batch = None
+            self.today = today
+        # ids are found first, so nothing is written if that fails
+        revlog = batch['revlog']
+        self._logIdsAt(revlog)
+        rows = []
+        for card in cards.values():
+            card.mod = intTime()
+            card.usn = self.col.usn()
+            rows.append(card.schedRow())
+        with self.cardsChanging(cards.keys()):
+            self.col.db.executemany(anki.cards.Card.schedSQL, rows)
+        self.col.db.executemany(
+            "insert into revlog values (?,?,?,?,?,?,?,?,?)", revlog)
+        self._saveStats(batch['stats'])
+        for card, state in states:
+            self.col.markReview(card, state)
+        for card, action in batch['leeches']:
+            self._leech(card, action)
+        self.reset()
+
+    def _answerCard(self, card, ease):
+        "Update CARD for EASE, logging it and adding to the deck stats."
         self.reps += 1
         card.reps += 1
         wasNew = (card.queue == 0) and card.type != 2
@@ -61,10 +160,7 @@ class Scheduler(object):
             self._updateStats(card, 'rev')
         else:
             raise Exception("Invalid queue")
-        self._updateStats(card, 'time', card.timeTaken())
-        card.mod = intTime()
-        card.usn = self.col.usn()
-        card.flushSched()
+        self._updateStats(card, 'time', self._timeTaken(card))
 
     def counts(self, card=None):
         counts = [self.newCount, self.lrnCount, self.revCount]
@@ -112,14 +208,27 @@ order by due""" % self._deckLimit(),
     ##########################################################################
 
     def _updateStats(self, card, type, cnt=1):
-        key = type+"Today"
-        for g in ([self.col.decks.get(card.did)] +
-                  self.col.decks.parents(card.did)):
-            # add
-            g[key][1] += cnt
+        if self._batch:
+            # saved at the end of the batch
+            counts = self._batch['stats'].setdefault(card.did, {})
+            counts[type] = counts.get(type, 0) + cnt
+            return
+        self._saveStats({card.did: {type: cnt}})
+
+    def _saveStats(self, stats):
+        "Add STATS, {did: {type: cnt}}, to the decks and their parents."
+        changed = {}
+        for did, counts in stats.items():
+            for g in ([self.col.decks.get(did)] +
+                      self.col.decks.parents(did)):
+                for type, cnt in counts.items():
+                    g[type+"Today"][1] += cnt
+                changed[g['id']] = g
+        for g in changed.values():
             self.col.decks.save(g)
 
-    def _walkingCount(self, limFn=None, cntFn=None):
+    def _walkingCount(self, limFn=None, cntFn=None, quotas=None):
+        "Total due over the active decks. QUOTAS gets each deck's (did, cnt)."
         tot = 0
         pcounts = {}
         # for each of the active decks
@@ -145,8 +254,166 @@ order by due""" % self._deckLimit(),
             pcounts[did] = lim - cnt
             # and add to running total
             tot += cnt
+            if quotas is not None:
+                quotas.append((did, cnt))
         return tot
 
+    def _deckPositions(self):
+        return dict((did, n) for n, did in enumerate(self.col.decks.active()))
+
+    def _fillQueue(self, idx, limFn, sqlFn):
+        """Fetch the next queueLimit due cards, taking each active deck's
+share in turn, within the deck and parent limits. SQLFN(did, limit) returns
+the query for a deck. The decks are fetched in one statement, as a union of
+the indexed per-deck queries."""
+        totals = self._dueTotals()
+        quotas = []
+        self._walkingCount(
+            limFn, lambda did, lim: min(totals.get(did, (0, 0))[idx], lim),
+            quotas)
+        parts = []
+        left = self.queueLimit
+        for did, cnt in quotas:
+            cnt = min(cnt, left)
+            if cnt:
+                parts.append("select * from (%s)" % sqlFn(did, cnt))
+                left -= cnt
+            if not left:
+                break
+        rows = []
+        for i in range(0, len(parts), QUEUE_UNION):
+            rows.extend(self.col.db.all(
+                " union all ".join(parts[i:i+QUEUE_UNION])))
+        return rows
+
+    # Due totals
+    ##########################################################################
+    # The number of new cards and reviews due today in each deck, before
+    # limits are applied. They're counted in one query the first time
+    # they're needed each day, and adjusted as the scheduler changes cards.
+    # Any other write to the cards table means they're counted again.
+
+    def _dueTotals(self):
+        "Return {did: [new, rev]}, counting them again if out of date."
+        if not self._totalsCurrent():
+            self._totals = {}
+            for did, queue, cnt in self.col.db.execute("""
+select did, queue, count() from cards
+where queue = 0 or (queue = 2 and due <= ?)
+group by did, queue""", self.today):
+                self._totals.setdefault(did, [0, 0])[queue/2] = cnt
+            self._totalsDay = self.today
+            self._totalsVer = self.col.db.writeCount("cards")
+        return self._totals
+
+    def _totalsCurrent(self, writes=None):
+        if writes is None:
+            writes = self.col.db.writeCount("cards")
+        return (self._totals is not None and self._totalsDay == self.today
+                and self._totalsVer == writes)
+
+    def _addTotal(self, n, did, queue, due):
+        if queue == 0:
+            idx = 0
+        elif queue == 2 and due <= self.today:
+            idx = 1
+        else:
+            return
+        self._totals.setdefault(did, [0, 0])[idx] += n
+
+    @contextmanager
+    def cardsChanging(self, ids):
+        """Keep the due totals current across a change to the cards IDS. The
+change must not write to any other cards."""
+        fetched = self._prefetchCurrent()
+        if not self._totalsCurrent():
+            yield
+            self._forgetPrefetched(ids, fetched)
+            return
+        def tally(n):
+            with self.col.db.idSet(ids) as sids:
+                for did, queue, due in self.col.db.execute("""
+select did, queue, due from cards where id in %s and
+(queue = 0 or (queue = 2 and due <= ?))""" % sids, self.today):
+                    self._addTotal(n, did, queue, due)
+        tally(-1)
+        yield
+        tally(1)
+        self._totalsVer = self.col.db.writeCount("cards")
+        self._forgetPrefetched(ids, fetched)
+
+    # Prefetching
+    ##########################################################################
+    # The next few cards in each queue are loaded with their notes and
+    # rendered ahead of time, so showing the next card doesn't wait on the
+    # db or the templates. They're thrown away if the cards, notes or models
+    # may have changed, other than by the scheduler's own changes.
+
+    _prefetchTables = ("cards", "notes", "col", "models")
+
+    def prefetchCards(self):
+        """Load and render the next cards in the queues that aren't already.
+Can be called when idle, so the next getCard() doesn't have to."""
+        if not self._prefetchCurrent():
+            self._prefetched = {}
+        if not self.prefetch:
+            return
+        ids = set()
+        if self._fillLrn():
+            ids.update(x[1] for x in nsmallest(self.prefetch, self._lrnQueue))
+        if self._fillRev():
+            ids.update(self._revQueue[-self.prefetch:])
+        if self._fillNew():
+            ids.update(x[0] for x in self._newQueue[-self.prefetch:])
+        ids.difference_update(self._prefetched)
+        if ids:
+            with self.col.db.idSet(ids) as sids:
+                cards = self.col.db.all(
+                    "select * from cards where id in " + sids)
+                nids = set(r[1] for r in cards)
+            with self.col.db.idSet(nids) as snids:
+                notes = dict((r[0], r[1:]) for r in self.col.db.execute("""
+select id, guid, mid, did, mod, usn, tags, flds, flags, data
+from notes where id in """ + snids))
+            for row in cards:
+                card = anki.cards.Card(self.col, row[0], row)
+                card._note = anki.notes.Note(
+                    self.col, id=row[1], row=notes[row[1]])
+                card._getQA()
+                # the deck name is shown by {{Deck}}
+                self._prefetched[card.id] = (
+                    card, self.col.decks.name(card.did))
+        self._prefetchVer = self._writeCounts()
+
+    def _card(self, id):
+        "Card ID, from the prefetched cards if it's there."
+        if self._prefetchCurrent():
+            hit = self._prefetched.pop(id, None)
+            if hit and hit[1] == self.col.decks.name(hit[0].did):
+                return hit[0]
+        return self.col.getCard(id)
+
+    def _writeCounts(self):
+        # models changed in memory are rendered differently before they're
+        # written, so their saves are counted too
+        return ([self.col.db.writeCount(t) for t in self._prefetchTables] +
+                [self.col.models.saves])
+
+    def _prefetchCurrent(self):
+        return self._prefetchVer == self._writeCounts()
+
+    def _prefetchKeep(self, cardWrites):
+        "Keep the prefetched cards after the scheduler wrote to cards."
+        counts = self._writeCounts()
+        if counts[0] == cardWrites and counts[1:] == self._prefetchVer[1:]:
+            self._prefetchVer = counts
+
+    def _forgetPrefetched(self, ids, current):
+        for id in ids:
+            self._prefetched.pop(id, None)
+        if current:
+            self._prefetchKeep(self.col.db.writeCount("cards"))
+
     # Deck list
     ##########################################################################
 
@@ -162,26 +429,42 @@ order by due""" % self._deckLimit(),
                 return None
             parts = parts[:-1]
             return "::".join(parts)
+        counts = self._deckCounts()
         for deck in decks:
             p = parent(deck['name'])
+            new, lrn, rev = counts.get(deck['id'], (0, 0, 0))
             # new
             nlim = self._deckNewLimitSingle(deck)
             if p:
                 nlim = min(nlim, lims[p][0])
-            new = self._newForDeck(deck['id'], nlim)
+            new = min(new, nlim, self.reportLimit)
             # learning
-            lrn = self._lrnForDeck(deck['id'])
+            lrn = min(lrn, self.reportLimit)
             # reviews
             rlim = self._deckRevLimitSingle(deck)
             if p:
                 rlim = min(rlim, lims[p][1])
-            rev = self._revForDeck(deck['id'], rlim)
+            rev = min(rev, rlim, self.reportLimit)
             # save to list
             data.append([deck['name'], deck['id'], lrn+rev, new])
             # add deck as a parent
             lims[deck['name']] = [nlim, rlim]
         return data
 
+    def _deckCounts(self):
+        """Return {did: [new, lrn, rev]} for decks with cards due, ignoring
+limits. All decks are counted in one pass over the cards."""
+        counts = {}
+        for did, queue, cnt in self.col.db.execute("""
+select did, queue, count() from cards
+where queue = 0 or (queue = 1 and due < ?) or (queue = 2 and due <= ?)
+group by did, queue""", intTime() + self.col.conf['collapseTime'],
+                                                   self.today):
+            if did not in counts:
+                counts[did] = [0, 0, 0]
+            counts[did][queue] = cnt
+        return counts
+
     def deckDueTree(self):
         return self._groupChildren(self.deckDueList())
 
@@ -254,14 +537,12 @@ order by due""" % self._deckLimit(),
     ##########################################################################
 
     def _resetNewCount(self):
-        cntFn = lambda did, lim: self.col.db.scalar("""
-select count() from (select 1 from cards where
-did = ? and queue = 0 limit ?)""", did, lim)
+        totals = self._dueTotals()
+        cntFn = lambda did, lim: min(totals.get(did, (0, 0))[0], lim)
         self.newCount = self._walkingCount(self._deckNewLimitSingle, cntFn)
 
     def _resetNew(self):
         self._resetNewCount()
-        self._newDids = self.col.decks.active()
         self._newQueue = []
         self._updateNewCardRatio()
 
@@ -270,35 +551,33 @@ did = ? and queue = 0 limit ?)""", did, lim)
             return True
         if not self.newCount:
             return False
-        while self._newDids:
-            did = self._newDids[0]
-            lim = min(self.queueLimit, self._deckNewLimit(did))
-            if lim:
-                # fill the queue with the current did
-                self._newQueue = self.col.db.all("""
-select id, due from cards where did = ? and queue = 0 limit ?""", did, lim)
-                if self._newQueue:
-                    self._newQueue.reverse()
-                    return True
-            # nothing left in the deck; move to next
-            self._newDids.pop(0)
+        rows = self._fillQueue(0, self._deckNewLimitSingle, lambda did, lim: """
+select id, due, did from cards where did = %d and queue = 0
+order by due limit %d""" % (did, lim))
+        # decks are studied in turn, in due order, popping from the end
+        pos = self._deckPositions()
+        rows.sort(key=lambda r: (pos[r[2]], r[1], r[0]), reverse=True)
+        self._newQueue = rows
+        return bool(rows)
 
     def _getNewCard(self):
         if not self._fillNew():
             return
-        (id, due) = self._newQueue.pop()
+        (id, due, did) = self._newQueue.pop()
         # move any siblings to the end?
-        conf = self.col.decks.confForDid(self._newDids[0])
+        conf = self.col.decks.confForDid(did)
         if conf['new']['separate']:
-            n = len(self._newQueue)
-            while self._newQueue and self._newQueue[-1][1] == due:
-                self._newQueue.insert(0, self._newQueue.pop())
+            # the deck's cards are at the end of the queue, and siblings are
+            # moved to the start of them
+            start = len(self._newQueue)
+            while start and self._newQueue[start-1][2] == did:
+                start -= 1
+            n = len(self._newQueue) - start
+            while n and self._newQueue[-1][1] == due:
+                self._newQueue.insert(start, self._newQueue.pop())
                 n -= 1
-                if not n:
-                    # we only have one note in the queue; stop rotating
-                    break
         self.newCount -= 1
-        return self.col.getCard(id)
+        return self._card(id)
 
     def _updateNewCardRatio(self):
         if self.col.conf['newSpread'] == NEW_CARDS_DISTRIBUTE:
@@ -322,29 +601,6 @@ select id, due from cards where did = ? and queue = 0 limit ?""", did, lim)
         elif self.newCardModulus:
             return self.reps and self.reps % self.newCardModulus == 0
 
-    def _deckNewLimit(self, did, fn=None):
-        if not fn:
-            fn = self._deckNewLimitSingle
-        sel = self.col.decks.get(did)
-        lim = -1
-        # for the deck and each of its parents
-        for g in [sel] + self.col.decks.parents(did):
-            rem = fn(g)
-            if lim == -1:
-                lim = rem
-            else:
-                lim = min(rem, lim)
-        return lim
-
-    def _newForDeck(self, did, lim):
-        "New count for a single deck."
-        if not lim:
-            return 0
-        lim = min(lim, self.reportLimit)
-        return self.col.db.scalar("""
-select count() from
-(select 1 from cards where did = ? and queue = 0 limit ?)""", did, lim)
-
     def _deckNewLimitSingle(self, g):
         "Limit for deck without parent limits."
         c = self.col.decks.confForDid(g['id'])
@@ -384,7 +640,7 @@ limit %d""" % (self._deckLimit(), self.reportLimit), lim=self.dayCutoff)
                 cutoff += self.col.conf['collapseTime']
             if self._lrnQueue[0][0] < cutoff:
                 id = heappop(self._lrnQueue)[1]
-                card = self.col.getCard(id)
+                card = self._card(id)
                 self.lrnCount -= card.left
                 return card
 
@@ -415,10 +671,10 @@ limit %d""" % (self._deckLimit(), self.reportLimit), lim=self.dayCutoff)
                 card.left = self._startingLeft(card)
             self.lrnCount += card.left
             delay = self._delayForGrade(conf, card.left)
-            if card.due < time.time():
+            if card.due < self._now():
                 # not collapsed; add some randomness
                 delay *= random.uniform(1, 1.25)
-            card.due = int(time.time() + delay)
+            card.due = int(self._now() + delay)
             heappush(self._lrnQueue, (card.due, card.id))
         self._logLrn(card, ease, conf, leaving, type, lastLeft)
 
@@ -471,101 +727,74 @@ limit %d""" % (self._deckLimit(), self.reportLimit), lim=self.dayCutoff)
     def _logLrn(self, card, ease, conf, leaving, type, lastLeft):
         lastIvl = -(self._delayForGrade(conf, lastLeft))
         ivl = card.ivl if leaving else -(self._delayForGrade(conf, card.left))
-        def log():
-            self.col.db.execute(
-                "insert into revlog values (?,?,?,?,?,?,?,?,?)",
-                int(time.time()*1000), card.id, self.col.usn(), ease,
-                ivl, lastIvl, card.factor, card.timeTaken(), type)
-        try:
-            log()
-        except:
-            # duplicate pk; retry in 10ms
-            time.sleep(0.01)
-            log()
+        self._log(card, ease, ivl, lastIvl, type)
 
     def removeFailed(self, ids=None):
         "Remove failed cards from the learning queue."
-        extra = ""
-        if ids:
-            extra = " and id in "+ids2str(ids)
-        self.col.db.execute("""
+        with self.col.db.idSet(ids or []) as sids:
+            extra = ""
+            if ids:
+                extra = " and id in "+sids
+            self.col.db.execute("""
 update cards set
 due = edue, queue = 2, mod = %d, usn = %d
 where queue = 1 and type = 2
 %s
 """ % (intTime(), self.col.usn(), extra))
 
-    def _lrnForDeck(self, did):
-        return self.col.db.scalar(
-            """
-select count() from
-(select 1 from cards where did = ? and queue = 1 and due < ? limit ?)""",
-            did, intTime() + self.col.conf['collapseTime'], self.reportLimit)
-
     # Reviews
     ##########################################################################
 
-    def _deckRevLimit(self, did):
-        return self._deckNewLimit(did, self._deckRevLimitSingle)
-
     def _deckRevLimitSingle(self, d):
         c = self.col.decks.confForDid(d['id'])
         return max(0, c['rev']['perDay'] - d['revToday'][1])
 
-    def _revForDeck(self, did, lim):
-        lim = min(lim, self.reportLimit)
-        return self.col.db.scalar(
-            """
-select count() from
-(select 1 from cards where did = ? and queue = 2
-and due <= ? limit ?)""",
-            did, self.today, lim)
-
     def _resetRevCount(self):
-        def cntFn(did, lim):
-            return self.col.db.scalar("""
-select count() from (select id from cards where
-did = ? and queue = 2 and due <= ? limit %d)""" % lim,
-                                      did, self.today)
+        totals = self._dueTotals()
+        cntFn = lambda did, lim: min(totals.get(did, (0, 0))[1], lim)
         self.revCount = self._walkingCount(
             self._deckRevLimitSingle, cntFn)
 
     def _resetRev(self):
         self._resetRevCount()
         self._revQueue = []
-        self._revDids = self.col.decks.active()
 
     def _fillRev(self):
         if self._revQueue:
             return True
         if not self.revCount:
             return False
-        while self._revDids:
-            did = self._newDids[0]
-            lim = min(self.queueLimit, self._deckRevLimit(did))
-            order = self._revOrder(did)
-            if lim:
-                # fill the queue with the current did
-                self._revQueue = self.col.db.list("""
-select id from cards where
-did = ? and queue = 2 and due <= ? %s limit ?""" % order,
-                                                  did, self.today, lim)
-                if self._revQueue:
-                    return True
-            # nothing left in the deck; move to next
-            self._newDids.pop(0)
-        if not order:
-            r = random.Random()
-            r.seed(self.today)
-            r.shuffle(self._revQueue)
-        else:
-            self._revQueue.reverse()
+        orders = {}
+        def order(did):
+            if did not in orders:
+                orders[did] = self._revOrder(did)
+            return orders[did]
+        rows = self._fillQueue(1, self._deckRevLimitSingle, lambda did, lim: """
+select id, did, ivl from cards where did = %d and queue = 2 and due <= %d
+%s limit %d""" % (did, self.today, order(did), lim))
+        if not rows:
+            return False
+        # decks are studied in turn, each in its configured order
+        pos = self._deckPositions()
+        r = random.Random()
+        r.seed(self.today)
+        def key(row):
+            o = order(row[1])
+            if o == "order by ivl desc":
+                k = -row[2]
+            elif o:
+                k = row[2]
+            else:
+                k = r.random()
+            return (pos[row[1]], k, row[0])
+        rows.sort(key=key, reverse=True)
+        self._revQueue = [row[0] for row in rows]
         return True
 
     def _getRevCard(self):
         if self._fillRev():
             self.revCount -= 1
-            return self.col.getCard(self._revQueue.pop())
+            return self._card(self._revQueue.pop())
 
     def _revOrder(self, did):
         d = self.col.decks.confForDid(did)
@@ -594,7 +823,7 @@ did = ? and queue = 2 and due <= ? %s limit ?""" % order,
         # put back in the learn queue?
         if conf['delays']:
             card.edue = card.due
-            card.due = int(self._delayForGrade(conf, 0) + time.time())
+            card.due = int(self._delayForGrade(conf, 0) + self._now())
             card.left = len(conf['delays'])
             card.queue = 1
             self.lrnCount += card.left
@@ -614,18 +843,59 @@ did = ? and queue = 2 and due <= ? %s limit ?""" % order,
         card.due = self.today + card.ivl
 
     def _logRev(self, card, ease):
-        def log():
-            self.col.db.execute(
+        self._log(card, ease, card.ivl, card.lastIvl, 1)
+
+    def _log(self, card, ease, ivl, lastIvl, type):
+        row = [card.id, self.col.usn(), ease, ivl, lastIvl, card.factor,
+               self._timeTaken(card), type]
+        if self._batch:
+            # given ids by _logIdsAt() at the end of the batch
+            self._batch['revlog'].append([int(self._now()*1000)] + row)
+        else:
+            self.col.db.defer(
                 "insert into revlog values (?,?,?,?,?,?,?,?,?)",
-                int(time.time()*1000), card.id, self.col.usn(), ease,
-                card.ivl, card.lastIvl, card.factor, card.timeTaken(),
-                1)
-        try:
-            log()
-        except:
-            # duplicate pk; retry in 10ms
-            time.sleep(0.01)
-            log()
+                self._logId(), *row)
+
+    def _logId(self):
+        "A unique revlog id. Ids are allocated here so writes can be queued."
+        return self.col.ids.next("revlog")
+
+    def _logIdsAt(self, rows):
+        """Replace the review times at the start of revlog ROWS with unique
+ids. Each is the first id from its time that isn't taken, so replaying the
+same reviews gives the same ids."""
+        if not rows:
+            return
+        times = [r[0] for r in rows]
+        # the ids taken up to HI are read as needed
+        hi = max(times) + len(times)
+        taken = set(self.col.db.list(
+            "select id from revlog where id between ? and ?", min(times), hi))
+        for r in rows:
+            while True:
+                if r[0] > hi:
+                    end = r[0] + len(rows)
+                    taken.update(self.col.db.list(
+                        "select id from revlog where id > ? and id <= ?",
+                        hi, end))
+                    hi = end
+                if r[0] not in taken:
+                    break
+                r[0] += 1
+            taken.add(r[0])
+        # the ids may be ahead of the allocator's
+        self.col.ids.reset()
+
+    def _now(self):
+        "The time of the answer, which is now unless replaying a batch."
+        if self._batch:
+            return self._batch['at']
+        return time.time()
+
+    def _timeTaken(self, card):
+        if self._batch:
+            return self._batch['taken']
+        return card.timeTaken()
 
     # Interval management
     ##########################################################################
@@ -696,19 +966,25 @@ did = ? and queue = 2 and due <= ? %s limit ?""" % order,
         # if over threshold or every half threshold reps after that
         if (lf >= card.lapses and
             (card.lapses-lf) % (max(lf/2, 1)) == 0):
-            # add a leech tag
-            f = card.note()
-            f.addTag("leech")
-            f.flush()
-            # handle
-            a = conf['leechAction']
-            if a == 0:
-                self.suspendCards([card.id])
-                card.queue = -1
-            # notify UI
-            runHook("leech", card)
+            if self._batch:
+                # handled once the batch is written
+                self._batch['leeches'].append((card, conf['leechAction']))
+            else:
+                self._leech(card, conf['leechAction'])
             return True
 
+    def _leech(self, card, action):
+        # add a leech tag
+        f = card.note()
+        f.addTag("leech")
+        f.flush()
+        # handle
+        if action == 0:
+            self.suspendCards([card.id])
+            card.queue = -1
+        # notify UI
+        runHook("leech", card)
+
     # Tools
     ##########################################################################
 
@@ -830,32 +1106,39 @@ your short-term review workload will become."""))
 
     def suspendCards(self, ids):
         "Suspend cards."
-        self.removeFailed(ids)
-        self.col.db.execute(
-            "update cards set queue=-1,mod=?,usn=? where id in "+
-            ids2str(ids), intTime(), self.col.usn())
+        with self.cardsChanging(ids):
+            self.removeFailed(ids)
+            with self.col.db.idSet(ids) as sids:
+                self.col.db.execute(
+                    "update cards set queue=-1,mod=?,usn=? where id in "+
+                    sids, intTime(), self.col.usn())
 
     def unsuspendCards(self, ids):
         "Unsuspend cards."
-        self.col.db.execute(
-            "update cards set queue=type,mod=?,usn=? "
-            "where queue = -1 and id in "+ ids2str(ids),
-            intTime(), self.col.usn())
+        with self.cardsChanging(ids):
+            with self.col.db.idSet(ids) as sids:
+                self.col.db.execute(
+                    "update cards set queue=type,mod=?,usn=? "
+                    "where queue = -1 and id in "+ sids,
+                    intTime(), self.col.usn())
 
     def buryNote(self, nid):
         "Bury all cards for note until next session."
         self.col.setDirty()
-        self.removeFailed(
-            self.col.db.list("select id from cards where nid = ?", nid))
-        self.col.db.execute("update cards set queue = -2 where nid = ?", nid)
+        ids = self.col.db.list("select id from cards where nid = ?", nid)
+        with self.cardsChanging(ids):
+            self.removeFailed(ids)
+            self.col.db.execute(
+                "update cards set queue = -2 where nid = ?", nid)
 
     # Resetting
     ##########################################################################
 
     def forgetCards(self, ids):
         "Put cards at the end of the new queue."
-        self.col.db.execute(
-            "update cards set type=0,queue=0,ivl=0 where id in "+ids2str(ids))
+        with self.col.db.idSet(ids) as sids:
+            self.col.db.execute(
+                "update cards set type=0,queue=0,ivl=0 where id in "+sids)
         pmax = self.col.db.scalar("select max(due) from cards where type=0")
         # takes care of mod + usn
         self.sortCards(ids, start=pmax+1)
@@ -876,7 +1159,10 @@ your short-term review workload will become."""))
     ##########################################################################
 
     def sortCards(self, cids, start=1, step=1, shuffle=False, shift=False):
-        scids = ids2str(cids)
+        with self.col.db.idSet(cids) as scids:
+            self._sortCards(scids, start, step, shuffle, shift)
+
+    def _sortCards(self, scids, start, step, shuffle, shift):
         now = intTime()
         nids = self.col.db.list(
             ("select distinct nid from cards where type = 0 and id in %s "
@@ -14,8 +14,9 @@ from anki.hooks import runFilter
 
 class CardStats(object):
 
-    def __init__(self, col, card):
+    def __init__(self, col, card, db=None):
         self.col = col
+        self.db = db or col.db
         self.card = card
 
     def report(self):
@@ -23,9 +24,9 @@ class CardStats(object):
         fmt = lambda x, **kwargs: fmtTimeSpan(x, short=True, **kwargs)
         self.txt = "<table width=100%>"
         self.addLine(_("Added"), self.date(c.id/1000))
-        first = self.col.db.scalar(
+        first = self.db.scalar(
             "select min(id) from revlog where cid = ?", c.id)
-        last = self.col.db.scalar(
+        last = self.db.scalar(
             "select max(id) from revlog where cid = ?", c.id)
         if first:
             self.addLine(_("First Review"), self.date(first/1000))
@@ -40,7 +41,7 @@ class CardStats(object):
             self.addLine(_("Interval"), fmt(c.ivl * 86400))
             self.addLine(_("Ease"), "%d%%" % (c.factor/10.0))
             self.addLine(_("Reviews"), "%d" % c.reps)
-            (cnt, total) = self.col.db.first(
+            (cnt, total) = self.db.first(
                 "select count(), sum(time)/1000 from revlog where cid = :id",
                 id=c.id)
             if cnt:
@@ -48,10 +49,14 @@ class CardStats(object):
                 self.addLine(_("Total Time"), self.time(total))
         elif c.queue == 0:
             self.addLine(_("Position"), c.due)
-        self.addLine(_("Card Type"), c.template()['name'])
-        self.addLine(_("Note Type"), c.model()['name'])
+        # the note is read through self.db, as this may be another thread
+        mid, did = self.db.first(
+            "select mid, did from notes where id = ?", c.nid)
+        model = self.col.models.get(mid)
+        self.addLine(_("Card Type"), model['tmpls'][c.ord]['name'])
+        self.addLine(_("Note Type"), model['name'])
         self.addLine(_("Card Deck"), self.col.decks.name(c.did))
-        self.addLine(_("Note Deck"), self.col.decks.name(c.note().did))
+        self.addLine(_("Note Deck"), self.col.decks.name(did))
         self.txt += "</table>"
         return self.txt
 
@@ -91,8 +96,9 @@ colSusp = "#ff0"
 
 class CollectionStats(object):
 
-    def __init__(self, col):
+    def __init__(self, col, db=None):
         self.col = col
+        self.db = db or col.db
         self._stats = None
         self.type = 0
         self.width = 600
@@ -175,7 +181,7 @@ table * { font-size: 14px; }
             lim += " and due-:today >= %d" % start
         if end is not None:
             lim += " and day < %d" % end
-        return self.col.db.all("""
+        return self.db.all("""
 select (due-:today)/:chunk as day,
 sum(case when ivl < 21 then 1 else 0 end), -- yng
 sum(case when ivl >= 21 then 1 else 0 end) -- mtr
@@ -317,7 +323,7 @@ group by day order by day""" % (self._limit(), lim),
             tf = 60.0 # minutes
         else:
             tf = 3600.0 # hours
-        return self.col.db.all("""
+        return self.db.all("""
 select
 (cast((id/1000 - :cut) / 86400.0 as int))/:chunk as day,
 sum(case when type = 0 then 1 else 0 end), -- lrn count
@@ -351,7 +357,7 @@ group by day order by day""" % lim,
             lim = "where " + " and ".join(lims)
         else:
             lim = ""
-        return self.col.db.first("""
+        return self.db.first("""
 select count(), abs(min(day)) from (select
 (cast((id/1000 - :cut) / 86400.0 as int)+1) as day
 from revlog %s
@@ -391,12 +397,12 @@ group by day order by day)""" % lim,
             chunk = 7; lim = " and grp <= 52"
         else:
             chunk = 30; lim = ""
-        data = [self.col.db.all("""
+        data = [self.db.all("""
 select ivl / :chunk as grp, count() from cards
 where did in %s and queue = 2 %s
 group by grp
 order by grp""" % (self._limit(), lim), chunk=chunk)]
-        return data + list(self.col.db.first("""
+        return data + list(self.db.first("""
 select count(), avg(ivl), max(ivl) from cards where did in %s and queue = 2""" %
                                          self._limit()))
 
@@ -459,7 +465,7 @@ select count(), avg(ivl), max(ivl) from cards where did in %s and queue = 2""" %
         lim = self._revlogLimit()
         if lim:
             lim = "where " + lim
-        return self.col.db.all("""
+        return self.db.all("""
 select (case
 when type in (0,2) then 0
 when lastIvl < 21 then 1
@@ -514,7 +520,7 @@ order by thetype, ease""" % lim)
         if lim:
             lim = " and " + lim
         sd = datetime.datetime.fromtimestamp(self.col.crt)
-        return self.col.db.all("""
+        return self.db.all("""
 select
 23 - ((cast((:cut - id/1000) / 3600.0 as int)) %% 24) as hour,
 sum(case when ease = 1 then 0 else 1 end) /
@@ -539,7 +545,7 @@ group by hour having count() > 30 order by hour""" % lim,
             d.append(dict(data=div[c], label=t, color=col))
         # text data
         i = []
-        (c, f) = self.col.db.first("""
+        (c, f) = self.db.first("""
 select count(id), count(distinct nid) from cards
 where did in %s """ % self._limit())
         self._line(i, _("Total cards"), c)
@@ -571,7 +577,7 @@ when you answer "good" on a review.''')
         return "<table width=400>" + "".join(i) + "</table>"
 
     def _factors(self):
-        return self.col.db.first("""
+        return self.db.first("""
 select
 min(factor) / 10.0,
 avg(factor) / 10.0,
@@ -579,7 +585,7 @@ max(factor) / 10.0
 from cards where did in %s and queue = 2""" % self._limit())
 
     def _cards(self):
-        return self.col.db.first("""
+        return self.db.first("""
 select
 sum(case when queue=2 and ivl >= 21 then 1 else 0 end), -- mtr
 sum(case when queue=1 or (queue=2 and ivl < 21) then 1 else 0 end), -- yng/lrn
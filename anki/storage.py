@@ -2,16 +2,55 @@
 # Copyright: Damien Elmes <anki@ichi2.net>
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
-import os, simplejson
+import os, time, simplejson
 from anki.lang import _
 from anki.utils import intTime
 from anki.db import DB
+from anki.hooks import runHook
 from anki.collection import _Collection
 from anki.consts import *
 from anki.stdmodels import addBasicModel, addClozeModel
 
-def Collection(path, lock=True, server=False, sync=True):
-    "Open a new or existing collection. Path must be unicode."
+# Performance profiles
+######################################################################
+# cacheSize: pages kept in memory
+# mmapSize: bytes of the file read through mmap, 0 to disable
+# checkpoint: wal pages written before an automatic checkpoint
+# tempStore: where temp tables and indices are kept
+# timeout: seconds to wait for another connection's lock
+# wal: use a write-ahead log, so readers don't block the writer
+# sync: fsync on commit; turning it off risks corruption on power loss
+# readOnly: refuse writes, and don't lock or save the collection. the file's
+#   journal mode is left as it is, so wal only applies if it's already on
+
+profiles = {
+    # a single user with a single collection
+    'desktop': dict(cacheSize=10000, mmapSize=0, checkpoint=1000,
+                    tempStore="memory", timeout=0, wal=True, sync=True,
+                    readOnly=False),
+    # many collections per process, and concurrent requests. mmap shares
+    # the os page cache between processes instead of a cache per collection
+    'server': dict(cacheSize=500, mmapSize=64*1024*1024, checkpoint=1000,
+                   tempStore="file", timeout=10, wal=True, sync=True,
+                   readOnly=False),
+    # creating or filling a collection that can be recreated if lost
+    'bulk-import': dict(cacheSize=50000, mmapSize=256*1024*1024,
+                        checkpoint=10000, tempStore="memory", timeout=0,
+                        wal=False, sync=False, readOnly=False),
+    # long scans for stats and reports, waiting out the writer if needed
+    'read-only-analytics': dict(cacheSize=20000, mmapSize=1024*1024*1024,
+                                checkpoint=1000, tempStore="memory",
+                                timeout=30, wal=True, sync=True,
+                                readOnly=True),
+}
+
+def Collection(path, lock=True, server=False, sync=True, profile=None):
+    """Open a new or existing collection. Path must be unicode.
+PROFILE is the name of one of the profiles above, or a dict with the same
+keys. By default it is 'desktop', or 'bulk-import' if SYNC is false.
+The time taken in ms is stored in col.openTime and passed to the colOpened
+hook."""
+    start = time.time()
     assert path.endswith(".anki2")
     path = os.path.abspath(path)
     create = not os.path.exists(path)
@@ -19,20 +58,21 @@ def Collection(path, lock=True, server=False, sync=True):
         base = os.path.basename(path)
         for c in ("/", ":", "\\"):
             assert c not in base
+    if profile is None:
+        profile = "desktop" if sync else "bulk-import"
+    if isinstance(profile, basestring):
+        profile = profiles[profile]
+    if profile['readOnly']:
+        assert not create
     # connect
-    db = DB(path)
+    db = DB(path, timeout=profile['timeout'])
     if create:
         ver = _createDB(db)
     else:
         ver = _upgradeSchema(db)
-    db.execute("pragma temp_store = memory")
-    if sync:
-        db.execute("pragma cache_size = 10000")
-        db.execute("pragma journal_mode = wal")
-    else:
-        db.execute("pragma synchronous = off")
+    _setProfile(db, profile)
     # add db to col and do any remaining upgrades
-    col = _Collection(db, server)
+    col = _Collection(db, server, profile)
     if ver < SCHEMA_VERSION:
         _upgrade(col, ver)
     elif create:
@@ -40,10 +80,26 @@ def Collection(path, lock=True, server=False, sync=True):
         addClozeModel(col)
         addBasicModel(col)
         col.save()
-    if lock:
+    if profile['readOnly']:
+        db.setQueryOnly()
+    elif lock:
         col.lock()
+    col.openTime = (time.time() - start)*1000
+    runHook("colOpened", col, col.openTime)
     return col
 
+def _setProfile(db, p):
+    db.execute("pragma cache_size = %d" % p['cacheSize'])
+    db.execute("pragma mmap_size = %d" % p['mmapSize'])
+    if p['tempStore'] != "memory":
+        db.setTempStore(p['tempStore'])
+    # changing the journal mode writes to the file
+    if p['wal'] and not p['readOnly']:
+        db.execute("pragma journal_mode = wal")
+        db.execute("pragma wal_autocheckpoint = %d" % p['checkpoint'])
+    if not p['sync']:
+        db.execute("pragma synchronous = off")
+
 # no upgrades necessary at the moment
 def _upgradeSchema(db):
     return SCHEMA_VERSION
@@ -56,6 +112,8 @@ def _upgrade(col, ver):
 def _createDB(db):
     db.execute("pragma page_size = 4096")
     db.execute("pragma legacy_file_format = 0")
+    # so free pages can be returned a few at a time, see col.maintain()
+    db.execute("pragma auto_vacuum = incremental")
     db.execute("vacuum")
     _addSchema(db)
     _updateIndices(db)
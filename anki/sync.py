@@ -7,7 +7,7 @@ from cStringIO import StringIO
 from datetime import date
 from anki.db import DB
 from anki.errors import *
-from anki.utils import ids2str, checksum, intTime
+from anki.utils import checksum, intTime
 from anki.consts import *
 from anki.lang import _
 from hooks import runHook
@@ -159,6 +159,8 @@ select count() from notes where id not in (select distinct nid from cards)""")
             mod = intTime(1000)
         self.col.ls = mod
         self.col._usn = self.maxUsn + 1
+        # merged objects keep their ids
+        self.col.ids.reset()
         self.col.save(mod=mod)
         return mod
 
@@ -269,9 +271,9 @@ from notes where %s""" % d)
 
     def getModels(self):
         if self.col.server:
-            return [m for m in self.col.models.all() if m['usn'] >= self.minUsn]
+            return self.col.models.since(self.minUsn)
         else:
-            mods = [m for m in self.col.models.all() if m['usn'] == -1]
+            mods = self.col.models.since(-1)
             for m in mods:
                 m['usn'] = self.maxUsn
             self.col.models.save()
@@ -289,15 +291,11 @@ from notes where %s""" % d)
 
     def getDecks(self):
         if self.col.server:
-            return [
-                [g for g in self.col.decks.all() if g['usn'] >= self.minUsn],
-                [g for g in self.col.decks.allConf() if g['usn'] >= self.minUsn]
-            ]
+            return self.col.decks.since(self.minUsn)
         else:
-            decks = [g for g in self.col.decks.all() if g['usn'] == -1]
+            decks, dconf = self.col.decks.since(-1)
             for g in decks:
                 g['usn'] = self.maxUsn
-            dconf = [g for g in self.col.decks.allConf() if g['usn'] == -1]
             for g in dconf:
                 g['usn'] = self.maxUsn
             self.col.decks.save()
@@ -320,14 +318,11 @@ from notes where %s""" % d)
 
     def getTags(self):
         if self.col.server:
-            return [t for t, usn in self.col.tags.allItems()
-                    if usn >= self.minUsn]
+            return self.col.tags.since(self.minUsn)
         else:
-            tags = []
-            for t, usn in self.col.tags.allItems():
-                if usn == -1:
-                    self.col.tags.tags[t] = self.maxUsn
-                    tags.append(t)
+            tags = self.col.tags.since(-1)
+            for t in tags:
+                self.col.tags.tags[t] = self.maxUsn
             self.col.tags.save()
             return tags
 
@@ -343,12 +338,12 @@ from notes where %s""" % d)
             logs)
 
     def newerRows(self, data, table, modIdx):
-        ids = (r[0] for r in data)
         lmods = {}
-        for id, mod in self.col.db.execute(
-            "select id, mod from %s where id in %s and %s" % (
-                table, ids2str(ids), self.usnLim())):
-            lmods[id] = mod
+        with self.col.db.idSet(r[0] for r in data) as sids:
+            for id, mod in self.col.db.execute(
+                "select id, mod from %s where id in %s and %s" % (
+                    table, sids, self.usnLim())):
+                lmods[id] = mod
         update = []
         for r in data:
             if r[0] not in lmods or lmods[r[0]] < r[modIdx]:
@@ -356,10 +351,11 @@ from notes where %s""" % d)
         return update
 
     def mergeCards(self, cards):
-        self.col.db.executemany(
-            "insert or replace into cards values "
-            "(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
-            self.newerRows(cards, "cards", 4))
+        rows = self.newerRows(cards, "cards", 4)
+        with self.col.sched.cardsChanging([r[0] for r in rows]):
+            self.col.db.executemany(
+                "insert or replace into cards values "
+                "(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", rows)
 
     def mergeNotes(self, notes):
         rows = self.newerRows(notes, "notes", 4)
@@ -2,8 +2,8 @@
 # Copyright: Damien Elmes <anki@ichi2.net>
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
-import simplejson
-from anki.utils import intTime, ids2str
+from anki.utils import intTime, LazyJSON
+from anki.registry import TagTable
 
 """
 Anki maintains a cache of used tags so it can quickly present a list of tags
@@ -15,6 +15,9 @@ This module manages the tag cache and tags for notes.
 
 class TagManager(object):
 
+    # parsed on first use
+    tags = LazyJSON("tags")
+
     # Registry save/load
     #############################################################
 
@@ -22,15 +25,38 @@ class TagManager(object):
         self.col = col
 
     def load(self, json):
-        self.tags = simplejson.loads(json)
+        "Load from JSON, or from the tags table if JSON is empty."
+        if json:
+            self.table = None
+            self.tags = json
+        else:
+            self.table = TagTable(self.col)
+            self.tags = self.table.load
         self.changed = False
 
+    def useTable(self):
+        "Move the registry into the tags table on the next flush."
+        self.table = TagTable(self.col)
+        self.table.mark()
+        self.changed = True
+
     def flush(self):
         if self.changed:
-            self.col.db.execute("update col set tags=?",
-                                 simplejson.dumps(self.tags))
+            if self.table:
+                self.table.flush(self.tags)
+            else:
+                self.col.db.execute("update col set tags=?",
+                                     TagManager.tags.dumps(self))
             self.changed = False
 
+    def since(self, usn):
+        "Tags with a usn of USN or later. -1 selects those not yet synced."
+        if self.table:
+            return self.table.since(usn, self.tags, self.changed)
+        if usn == -1:
+            return [t for t, u in self.allItems() if u == -1]
+        return [t for t, u in self.allItems() if u >= usn]
+
     # Registering and fetching tags
     #############################################################
 
@@ -41,6 +67,8 @@ class TagManager(object):
         for t in tags:
             if t not in self.tags:
                 self.tags[t] = self.col.usn() if usn is None else usn
+                if self.table:
+                    self.table.mark(t)
                 self.changed = True
 
     def all(self):
@@ -49,19 +77,27 @@ class TagManager(object):
     def registerNotes(self, nids=None):
         "Add any missing tags from notes to the tags list."
         # when called without an argument, the old list is cleared first.
-        if nids:
-            lim = " where id in " + ids2str(nids)
-        else:
-            lim = ""
-            self.tags = {}
-            self.changed = True
-        self.register(set(self.split(
-            " ".join(self.col.db.list("select distinct tags from notes"+lim)))))
+        with self.col.db.idSet(nids or []) as snids:
+            if nids:
+                lim = " where id in " + snids
+            else:
+                lim = ""
+                self.tags = {}
+                if self.table:
+                    self.table.mark()
+                self.changed = True
+            tags = set()
+            for (t,) in self.col.db.iter(
+                "select distinct tags from notes"+lim):
+                tags.update(self.split(t))
+        self.register(tags)
 
     def allItems(self):
         return self.tags.items()
 
     def save(self):
+        if self.table:
+            self.table.mark()
         self.changed = True
 
     # Bulk addition/removal from notes
@@ -83,11 +119,12 @@ class TagManager(object):
             fn = self.remFromStr
         lim = " or ".join(
             [l+"like :_%d" % c for c, t in enumerate(newTags)])
-        res = self.col.db.all(
-            "select id, tags from notes where id in %s and %s" % (
-                ids2str(ids), lim),
-            **dict([("_%d" % x, '%% %s %%' % y)
-                    for x, y in enumerate(newTags)]))
+        with self.col.db.idSet(ids) as sids:
+            res = self.col.db.all(
+                "select id, tags from notes where id in %s and %s" % (
+                    sids, lim),
+                **dict([("_%d" % x, '%% %s %%' % y)
+                        for x, y in enumerate(newTags)]))
         # update tags
         nids = []
         def fix(row):
@@ -174,9 +211,10 @@ class TagManager(object):
 
     def setDeckForTags(self, yes, no, did):
         nids = self.selTagNids(yes, no)
-        self.col.db.execute(
-            "update cards set did=?,mod=?,usn=? where nid in "+ids2str(nids),
-            did, intTime(), self.col.usn())
+        with self.col.db.idSet(nids) as snids:
+            self.col.db.execute(
+                "update cards set did=?,mod=?,usn=? where nid in "+snids,
+                did, intTime(), self.col.usn())
 
     # Sync handling
     ##########################################################################
@@ -129,13 +129,15 @@ and c.ordinal != cm.ordinal"""):
     def _upgradeSchema(self):
         "Alter tables prior to ORM initialization."
         db = self.db
-        # speed up the upgrade
-        db.execute("pragma temp_store = memory")
-        db.execute("pragma cache_size = 10000")
-        db.execute("pragma synchronous = off")
         # these weren't always correctly set
         db.execute("pragma page_size = 4096")
         db.execute("pragma legacy_file_format = 0")
+        # speed up the upgrade
+        with db.bulk():
+            self._upgradeTables()
+
+    def _upgradeTables(self):
+        db = self.db
 
         # notes
         ###########
@@ -3,7 +3,7 @@
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
 import re, os, random, time, types, math, htmlentitydefs, subprocess, \
-    tempfile, shutil, string, httplib2
+    tempfile, shutil, string, httplib2, simplejson
 from hashlib import sha1
 from anki.lang import _, ngettext
 from anki.consts import *
@@ -174,22 +174,42 @@ def ids2str(ids):
     """Given a list of integers, return a string '(int1,int2,...)'."""
     return "(%s)" % ",".join(str(i) for i in ids)
 
-def timestampID(db, table):
-    "Return a non-conflicting timestamp for table."
-    # be careful not to create multiple objects without flushing them, or they
-    # may share an ID.
-    t = intTime(1000)
-    while db.scalar("select id from %s where id = ?" % table, t):
-        t += 1
-    return t
-
-def maxID(db):
-    "Return the first safe ID to use."
-    now = intTime(1000)
-    for tbl in "cards", "notes":
-        now = max(now, db.scalar(
-                "select max(id) from %s" % tbl))
-    return now + 1
+class IdAllocator(object):
+    """Hands out increasing timestamp ids, with a sequence per table. Each
+sequence is seeded from the largest existing id when first used. Tables are
+checked for rows another writer has added past the sequence before each id is
+handed out, and the sequence skips over them."""
+
+    def __init__(self, db):
+        self.db = db
+        self.reset()
+
+    def reset(self):
+        self._last = {}
+
+    def next(self, table, existing=None):
+        "Return a new id for TABLE."
+        return self.take(table, 1, existing)
+
+    def take(self, table, n, existing=None):
+        """Reserve N consecutive ids for TABLE and return the first. The
+registries aren't tables, so they pass their EXISTING ids instead."""
+        last = self._last.get(table)
+        if last is None:
+            if existing is not None:
+                last = max([int(x) for x in existing] or [0])
+            else:
+                last = self.db.scalar("select max(id) from %s" % table) or 0
+        first = max(intTime(1000), last + 1)
+        if existing is None:
+            # rows queued by defer() are all below FIRST, so the check
+            # doesn't need to flush them
+            clash = self.db.peek(
+                "select max(id) from %s where id >= ?" % table, first)
+            if clash:
+                first = clash + 1
+        self._last[table] = first + n - 1
+        return first
 
 # used in ankiweb
 def base62(num, extra=""):
@@ -228,6 +248,44 @@ def fieldChecksum(data):
     # 32 bit unsigned number from first 8 digits of md5 hash
     return int(checksum(data.encode("utf-8"))[:8], 16)
 
+# Lazily parsed JSON
+##############################################################################
+
+class LazyJSON(object):
+    """An attribute set to JSON text, which is parsed the first time it's
+read. Registries that are never used are never parsed. It can also be set to
+a function, which is called to load the value on first read."""
+
+    def __init__(self, name):
+        self.name = "_" + name
+
+    def __get__(self, obj, type=None):
+        if obj is None:
+            return self
+        val = obj.__dict__[self.name]
+        if isinstance(val, basestring):
+            val = obj.__dict__[self.name] = simplejson.loads(val)
+        elif callable(val):
+            val = obj.__dict__[self.name] = val()
+        return val
+
+    def __set__(self, obj, val):
+        obj.__dict__[self.name] = val
+
+    def load(self, obj, *args):
+        "Read the attribute now, passing ARGS to a load function."
+        val = obj.__dict__[self.name]
+        if callable(val):
+            obj.__dict__[self.name] = val(*args)
+        return self.__get__(obj)
+
+    def dumps(self, obj):
+        "The attribute as JSON, without parsing it if it hasn't been read."
+        val = obj.__dict__[self.name]
+        if isinstance(val, basestring):
+            return val
+        return simplejson.dumps(val)
+
 # Temp files
 ##############################################################################
 
@@ -143,3 +143,316 @@ def test_timestamps():
         addBasicModel(deck)
     assert len(deck.models.models) == 102
 
+
+def test_profiles():
+    deck = getEmptyDeck(profile="server")
+    db = deck.db
+    assert db.scalar("pragma cache_size") == 500
+    assert db.scalar("pragma temp_store") == 1
+    assert db.scalar("pragma journal_mode") == "wal"
+    # id sets still work after temp_store changed
+    assert db._haveIdSets
+    f = deck.newNote()
+    f['Front'] = u"1"
+    deck.addNote(f)
+    deck.remCards(range(1, 100) + [f.cards()[0].id])
+    assert not deck.cardCount()
+    # the profile is applied again on reopen
+    deck.close()
+    deck.reopen()
+    assert deck.db.scalar("pragma cache_size") == 500
+    assert deck.readPool.timeout == 10
+    path = deck.path
+    deck.close()
+    # reports can't write by mistake
+    before = open(path, "rb").read()
+    deck = aopen(path, profile="read-only-analytics")
+    assert deck.db.scalar("pragma query_only") == 1
+    # or by switching the file to wal
+    assert deck.db.scalar("pragma journal_mode") == "delete"
+    assert not deck.readPool
+    assertException(Exception, lambda: deck.db.execute(
+        "update cards set mod = 0"))
+    assert not deck.findCards("")
+    deck.close()
+    assert open(path, "rb").read() == before
+    deck = getEmptyDeck(sync=False)
+    assert deck.db.scalar("pragma synchronous") == 0
+    assert deck.db.scalar("pragma journal_mode") != "wal"
+
+def test_lazyLoad():
+    deck = getEmptyDeck()
+    path = deck.path
+    deck.close()
+    deck = aopen(path)
+    assert deck.openTime > 0
+    # registries the scheduler doesn't need are left as text
+    assert isinstance(deck.models.__dict__['_models'], basestring)
+    assert isinstance(deck.tags.__dict__['_tags'], basestring)
+    # and saved untouched if unread
+    deck.decks.select(1)
+    deck.close()
+    deck = aopen(path)
+    assert len(deck.models.models) == 2
+    assert not isinstance(deck.models.__dict__['_models'], basestring)
+    deck.close()
+
+def test_registryTables():
+    deck = getEmptyDeck()
+    did = deck.decks.id("new deck")
+    f = deck.newNote()
+    f['Front'] = u"1"
+    f.tags = [u"foo"]
+    deck.addNote(f)
+    deck.useRegistryTables()
+    assert deck.db.scalar("select models from col") == ""
+    assert deck.db.scalar("select count() from decks") == 2
+    assert deck.db.list("select tag from tags") == ["foo"]
+    # only changed objects are written
+    deck.db.profile()
+    g = deck.decks.get(did)
+    g['desc'] = u"changed"
+    deck.decks.save(g)
+    deck.save()
+    s = [x for x in deck.db.profiler.stats() if "into decks" in x['sql']]
+    assert s[0]['rows'] == 1
+    assert deck.decks.since(-1) == [[g], []]
+    # and removed objects deleted
+    deck.decks.rem(did)
+    deck.save()
+    assert deck.db.scalar("select count() from decks") == 1
+    # reopening reads the tables
+    path = deck.path
+    deck.close()
+    deck = aopen(path)
+    assert deck.models.table
+    assert len(deck.models.all()) == 2
+    assert deck.tags.all() == ["foo"]
+    # unsaved changes are seen by since() without being written
+    deck.tags.register([u"bar"])
+    assert deck.tags.since(-1) == [u"bar", u"foo"]
+    assert not deck.db.list("select tag from tags where tag = 'bar'")
+    deck.rollback()
+    assert deck.tags.all() == ["foo"]
+    # and the tables use the new connection after a reopen
+    deck.close()
+    deck.reopen()
+    deck.tags.register([u"baz"])
+    deck.save()
+    assert deck.db.list("select tag from tags where tag = 'baz'")
+    deck.close()
+
+def test_ids():
+    deck = getEmptyDeck()
+    # notes that haven't been flushed don't share ids
+    f = deck.newNote()
+    f2 = deck.newNote()
+    assert f2.id > f.id
+    f['Front'] = u"1"
+    deck.addNote(f)
+    # ids in the future are seen after a reset
+    future = f.id + 10**6
+    deck.db.execute("update cards set id = ?", future)
+    deck.ids.reset()
+    f = deck.newNote()
+    f['Front'] = u"2"
+    deck.addNote(f)
+    assert f.cards()[0].id == future + 1
+    # and rows added by another writer are skipped without one
+    deck.db.execute("update cards set id = ? where id = ?",
+                    future + 10**6, future + 1)
+    f = deck.newNote()
+    f['Front'] = u"3"
+    deck.addNote(f)
+    assert f.cards()[0].id == future + 10**6 + 1
+    # revlog ids are checked without flushing queued reviews
+    deck.db.writeBehind()
+    deck.reset()
+    c = deck.sched.getCard()
+    deck.sched.answerCard(c, 3)
+    assert deck.db._pending
+    deck.db.execute("insert into revlog values (?,0,0,0,0,0,0,0,0)",
+                    deck.ids._last['revlog'] + 1)
+    c = deck.sched.getCard()
+    deck.sched.answerCard(c, 3)
+    assert deck.db._pending
+    deck.db.flushWrites()
+    assert deck.db.scalar("select count() from revlog") == 3
+    deck.db.writeBehind(size=None)
+    # and blocks are reserved
+    first = deck.ids.take("cards", 10)
+    assert deck.ids.next("cards") == first + 10
+    # decks created together get their own ids
+    assert deck.decks.id("a") != deck.decks.id("b")
+
+def test_addNotes():
+    deck = getEmptyDeck()
+    notes = []
+    for i in range(5):
+        f = deck.newNote()
+        f['Front'] = u"<b>%d</b>" % i
+        f['Back'] = u"back"
+        f.tags = [u"tag%d" % i]
+        notes.append(f)
+    # no cards for an empty note
+    notes[4]['Front'] = u""
+    pos = deck.conf['nextPos']
+    assert deck.addNotes(iter(notes)) == 4
+    assert deck.noteCount() == 4
+    assert deck.conf['nextPos'] == pos + 4
+    assert sorted(deck.db.list("select due from cards")) == range(pos, pos+4)
+    assert deck.db.list("select sfld from notes order by id") == range(4)
+    assert sorted(deck.tags.all()) == ["tag0", "tag1", "tag2", "tag3"]
+    # the same as adding them one at a time
+    f = deck.getNote(notes[0].id)
+    f2 = deck.newNote()
+    f2['Front'] = u"<b>0</b>"
+    f2['Back'] = u"back"
+    f2.tags = [u"tag0"]
+    deck.addNote(f2)
+    f2.load()
+    assert (f.fields, f.tags, f.mid, f.did) == (
+        f2.fields, f2.tags, f2.mid, f2.did)
+    assert (deck.db.first("select csum, sfld from notes where id = ?", f.id)
+            == deck.db.first("select csum, sfld from notes where id = ?",
+                             f2.id))
+    assert len(f.cards()) == len(f2.cards()) == 1
+
+def test_renderQA():
+    d = getEmptyDeck()
+    m = d.models.current()
+    m['tmpls'][0]['qfmt'] = "{{Front}} {{Tags}} {{Deck}}"
+    d.models.save(m)
+    for i in range(30):
+        f = d.newNote()
+        f['Front'] = u"q%d" % i
+        f['Back'] = u"a%d" % i
+        f.tags = ["t%d" % i]
+        d.addNote(f)
+    cids = d.db.list("select id from cards order by id")
+    res = d.renderQA(cids)
+    assert len(res) == 30
+    byId = dict((r['id'], r) for r in res)
+    c = d.getCard(cids[3])
+    assert byId[c.id] == c._getQA()
+    assert "t3" in byId[c.id]['q'] and "Default" in byId[c.id]['q']
+    # the same cards when rendered in other processes
+    import anki.collection, anki.template
+    old = anki.collection.ITER_BATCH
+    anki.collection.ITER_BATCH = 7
+    made = []
+    tmpl = anki.template.Template
+    def count(*a, **kw):
+        made.append(1)
+        return tmpl(*a, **kw)
+    try:
+        par = d.renderQA(cids, processes=2)
+        # the templates are compiled once for the call, not for each batch
+        anki.template.Template = count
+        d.renderQA(cids)
+        assert len(made) == 2
+    finally:
+        anki.collection.ITER_BATCH = old
+        anki.template.Template = tmpl
+    assert sorted(par) == sorted(res)
+    # iterQA yields the same
+    assert sorted(d.iterQA(cids)) == sorted(res)
+
+def test_backup():
+    d = getEmptyDeck()
+    for i in range(5):
+        f = d.newNote()
+        f['Front'] = u"%d" % i
+        d.addNote(f)
+    d.save()
+    path = d.path.replace(".anki2", "-backup.anki2")
+    b = d.backup(path, rowsPerStep=2)
+    assert not b.step()
+    # changes made during the backup aren't included
+    f = d.newNote()
+    f['Front'] = u"new"
+    d.addNote(f)
+    d.save()
+    b.run()
+    assert b.copied > 10
+    b2 = aopen(path)
+    assert b2.noteCount() == 5
+    assert b2.db.scalar("pragma integrity_check") == "ok"
+    assert b2.models.current()['name'] == d.models.current()['name']
+    b2.close()
+    # older backups are kept
+    d.backup(path, keep=2).run()
+    b2 = aopen(path)
+    assert b2.noteCount() == 6
+    b2.close()
+    b2 = aopen(path.replace(".anki2", ".1.anki2"))
+    assert b2.noteCount() == 5
+    b2.close()
+    # and it's skipped if nothing changed since the last backup
+    assert not d.backup(path)
+    # closing the collection finishes a backup in progress
+    f = d.newNote()
+    f['Front'] = u"new2"
+    d.addNote(f)
+    d.save()
+    b = d.backup(path, rowsPerStep=2)
+    assert not b.step()
+    # as does starting another
+    path2 = path.replace("-backup", "-backup2")
+    b2 = d.backup(path2, rowsPerStep=2)
+    assert b.done and not b2.done
+    d.close()
+    assert b2.done
+    for p in path, path2:
+        b2 = aopen(p)
+        assert b2.noteCount() == 7
+        b2.close()
+
+def test_fixIntegrity():
+    d = getEmptyDeck()
+    f = d.newNote()
+    f['Front'] = u"one"
+    f.tags = ["foo"]
+    d.addNote(f)
+    d.db.execute("update notes set sfld = 'x'")
+    d.tags.tags['unused'] = 0
+    seen = []
+    from anki.hooks import addHook, remHook
+    def onProgress(stage, n):
+        seen.append(stage)
+    addHook("fixIntegrityProgress", onProgress)
+    try:
+        # with no time left, nothing is done
+        assert d.fixIntegrity(budget=0) == "Database partially checked."
+        assert d.pendingChecks == list(d.checkStages)
+        assertException(Exception, lambda: d.fixIntegrity(stages=["nope"]))
+        # stages can be run separately, and resumed
+        d.fixIntegrity(quick=True, stages=["check", "tags"])
+        assert seen == ["check", "tags"]
+        assert "unused" not in d.tags.all()
+        assert d.db.scalar("select sfld from notes") == "x"
+        assert d.fixIntegrity().startswith("Database rebuilt")
+        assert seen[2:] == list(d.checkStages)
+        assert not d.pendingChecks
+        assert d.db.scalar("select sfld from notes") == "one"
+        # and resuming once all stages are done runs none
+        d.fixIntegrity(stages=d.pendingChecks)
+        assert len(seen) == 2 + len(d.checkStages)
+    finally:
+        remHook("fixIntegrityProgress", onProgress)
+
+def test_maintain():
+    d = getEmptyDeck()
+    assert d.db.scalar("pragma auto_vacuum") == 2
+    for i in range(500):
+        f = d.newNote()
+        f['Front'] = u"x"*200
+        d.addNote(f)
+    d.save()
+    d.remNotes(d.db.list("select id from notes"))
+    d.save()
+    assert d.db.scalar("pragma freelist_count")
+    d.maintain(budget=10)
+    assert not d.db.scalar("pragma freelist_count")
+    # with no time, only the wal is checkpointed
+    d.maintain(budget=0)
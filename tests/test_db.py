@@ -0,0 +1,297 @@
+# coding: utf-8
+
+import threading
+from tests.shared import assertException, getEmptyDeck
+from anki.db import classify
+from anki.hooks import addHook, remHook
+from anki.utils import ids2str
+from anki import Collection as aopen
+
+def test_classify():
+    assert classify("select id from cards where nid = ?") == (False, "cards")
+    assert classify("""
+select count() from (select 1 from cards where
+did = ? and queue = 0 limit ?)""") == (False, "cards")
+    assert classify("insert or replace into notes values (?)") == (
+        True, "notes")
+    assert classify("  UPDATE cards set queue = 1") == (True, "cards")
+    assert classify("delete from revlog where id = ?") == (True, "revlog")
+    assert classify("pragma integrity_check") == (False, None)
+
+def test_modTracking():
+    deck = getEmptyDeck()
+    deck.save()
+    assert not deck.db.mod
+    deck.db.execute("select * from cards")
+    assert not deck.db.mod
+    deck.db.execute("update cards set mod = 1")
+    assert deck.db.mod
+    # the classification is cached per connection
+    assert "update cards set mod = 1" in deck.db._stmts
+
+def test_profile():
+    deck = getEmptyDeck()
+    p = deck.db.profile()
+    for i in range(3):
+        f = deck.newNote()
+        f['Front'] = u"%d" % i
+        deck.addNote(f)
+    deck.db.list("select id from cards where id in (1,2,3)")
+    deck.db.list("select id from cards where id in (4,5)")
+    stats = dict((s['sql'], s) for s in p.stats())
+    s = stats["select id from cards where id in (?)"]
+    assert s['count'] == 2
+    assert s['callers'][0][0] == "tests.test_db.test_profile"
+    s = stats["select ? from cards where nid = ?"]
+    assert s['count'] == 3
+    assert s['callers'][0][0] == "notes.Note._preFlush"
+    assert s['p95'] <= s['max']
+    assert "insert or replace into cards" in p.dump()
+    deck.db.profile(False)
+    assert not deck.db.profiler
+
+def test_slowLog():
+    deck = getEmptyDeck()
+    logged = []
+    def onSlow(entry):
+        logged.append(entry)
+    addHook("slowQuery", onSlow)
+    # a zero threshold logs everything
+    deck.db.logSlow(0, keep=2)
+    deck.save()
+    deck.db.execute("update col set dty = 5")
+    deck.db.scalar("select count() from cards where did = ? and queue = 0", 1)
+    e = logged[-1]
+    assert e['args'] == [1]
+    assert e['caller'] == "tests.test_db.test_slowLog"
+    assert "ix_cards_sched" in " ".join(e['plan'])
+    deck.db.executemany("update cards set mod = ? where id = ?",
+                        [(1, 2), (3, 4)])
+    assert logged[-1]['args'] == [3, 4]
+    assert len(deck.db.slowQueries) == 2
+    # explaining must not have committed the update
+    deck.db.rollback()
+    assert deck.db.scalar("select dty from col") != 5
+    deck.db.logSlow(None)
+    n = len(logged)
+    deck.db.scalar("select 1")
+    assert len(logged) == n
+    remHook("slowQuery", onSlow)
+
+def test_idSet():
+    deck = getEmptyDeck()
+    for i in range(60):
+        f = deck.newNote()
+        f['Front'] = u"%d" % i
+        deck.addNote(f)
+    deck.save()
+    cids = deck.db.list("select id from cards")
+    # short lists are inlined
+    with deck.db.idSet(cids[:2]) as s:
+        assert s == ids2str(cids[:2])
+    # long ones are loaded into the temp table, and sets can be nested
+    with deck.db.idSet(cids) as s:
+        with deck.db.idSet(cids[:50]) as s2:
+            assert s != s2
+            assert deck.db.scalar(
+                "select count() from cards where id in "+s) == 60
+            assert deck.db.scalar(
+                "select count() from cards where id in "+s2) == 50
+        assert not deck.db.mod
+    assert not deck.db.scalar("select count() from temp.idsets")
+    # bulk operations use them
+    deck.sched.suspendCards(cids)
+    assert deck.db.scalar(
+        "select count() from cards where queue = -1") == 60
+    deck.remCards(cids[:55])
+    assert deck.cardCount() == 5
+    assert deck.noteCount() == 5
+    # and they don't commit the open transaction
+    deck.rollback()
+    assert deck.cardCount() == 60
+
+def test_iter():
+    deck = getEmptyDeck()
+    for i in range(25):
+        f = deck.newNote()
+        f['Front'] = u"%d" % i
+        deck.addNote(f)
+    rows = list(deck.db.iter("select id from notes order by id", batch=10))
+    assert [r[0] for r in rows] == deck.db.list(
+        "select id from notes order by id")
+    assert len(list(deck.db.iter(
+        "select id from cards where id > ?", 0, batch=7))) == 25
+    # rebuilding the whole field cache
+    deck.db.execute("update notes set sfld = '', csum = 0")
+    deck.updateFieldCache()
+    assert not deck.db.scalar("select 1 from notes where csum = 0")
+    assert not deck.db.scalar("select 1 from notes where sfld = ''")
+
+def test_bulk():
+    deck = getEmptyDeck()
+    db = deck.db
+    def indices():
+        return sorted(db.list(
+            "select name from sqlite_master where type = 'index' "
+            "and sql is not null"))
+    before = indices()
+    sync = db.scalar("pragma synchronous")
+    with db.bulk(dropIndices=True):
+        assert not indices()
+        assert db.scalar("pragma synchronous") == 0
+        f = deck.newNote()
+        f['Front'] = u"1"
+        deck.addNote(f)
+    assert indices() == before
+    assert db.scalar("pragma synchronous") == sync
+    assert db.scalar("pragma journal_mode") == "wal"
+    # committed
+    deck.rollback()
+    assert deck.cardCount() == 1
+    # and rolled back on error
+    try:
+        with db.bulk():
+            f = deck.newNote()
+            f['Front'] = u"2"
+            deck.addNote(f)
+            raise Exception()
+    except Exception:
+        pass
+    assert deck.cardCount() == 1
+    # the collection's version reloads the registries too
+    try:
+        with deck.bulk(dropIndices=True):
+            deck.decks.id("new")
+            raise Exception()
+    except Exception:
+        pass
+    assert "new" not in deck.decks.allNames()
+    assert indices() == before
+    # and a check restores indices lost to an interrupted import
+    db.execute("drop index ix_cards_nid")
+    deck.fixIntegrity(stages=["check"])
+    assert indices() == before
+
+def test_writeBehind():
+    deck = getEmptyDeck()
+    for i in range(5):
+        f = deck.newNote()
+        f['Front'] = unicode(i)
+        deck.addNote(f)
+    deck.save()
+    deck.db.writeBehind(size=100)
+    deck.reset()
+    for i in range(3):
+        c = deck.sched.getCard()
+        deck.sched.answerCard(c, 3)
+    assert deck.db._pending
+    # reading a queued table flushes first
+    assert deck.db.scalar("select count() from revlog") == 3
+    assert not deck.db._pending
+    # ids are unique even when answering quickly
+    assert len(set(deck.db.list("select id from revlog"))) == 3
+    # a rollback discards the queue
+    deck.reset()
+    c = deck.sched.getCard()
+    deck.sched.answerCard(c, 3)
+    assert deck.db._pending
+    deck.rollback()
+    assert deck.db.scalar("select count() from revlog") == 0
+    # and a full queue is written out
+    deck.db.writeBehind(size=2)
+    deck.reset()
+    c = deck.sched.getCard()
+    deck.sched.answerCard(c, 3)
+    assert not deck.db._pending
+    # and closing the database writes out what's queued
+    deck.db.writeBehind()
+    deck.reset()
+    c = deck.sched.getCard()
+    deck.sched.answerCard(c, 3)
+    assert deck.db._pending
+    path = deck.path
+    deck.db.close()
+    deck.db = None
+    deck = aopen(path)
+    assert deck.db.scalar("select count() from revlog") == 2
+
+def test_readPool():
+    deck = getEmptyDeck()
+    f = deck.newNote()
+    f['Front'] = u"one"
+    deck.addNote(f)
+    deck.save()
+    results = []
+    def search():
+        with deck.reader() as db:
+            results.append(deck.findCards("one", db=db))
+            results.append(deck.stats(db=db).report())
+    t = threading.Thread(target=search)
+    t.start()
+    t.join()
+    assert results[0] == [f.cards()[0].id]
+    assert results[1]
+    # readers see a snapshot of what has been committed
+    with deck.reader() as db:
+        assert db.scalar("select count() from notes") == 1
+        f = deck.newNote()
+        f['Front'] = u"two"
+        deck.addNote(f)
+        deck.save()
+        assert db.scalar("select count() from notes") == 1
+        assertException(Exception, lambda: db.execute("delete from notes"))
+    with deck.reader() as db:
+        assert db.scalar("select count() from notes") == 2
+    # connections are reused
+    assert deck.readPool._open == 1
+    deck.close()
+    assert deck.readPool._open == 0
+    # card stats can be made in another thread, with registries that
+    # haven't been loaded yet
+    deck = getEmptyDeck()
+    f = deck.newNote()
+    f['Front'] = u"one"
+    deck.addNote(f)
+    deck.useRegistryTables()
+    deck.save()
+    path = deck.path
+    deck.close()
+    deck = aopen(path)
+    c = deck.getCard(deck.db.scalar("select id from cards"))
+    def cardStats():
+        with deck.reader() as db:
+            results.append(deck.cardStats(c, db=db))
+    results = []
+    t = threading.Thread(target=cardStats)
+    t.start()
+    t.join()
+    assert "Basic" in results[0]
+    deck.close()
+    # without wal, reads go to the collection's connection
+    deck = getEmptyDeck(sync=False)
+    assert not deck.readPool
+    with deck.reader() as db:
+        assert db is deck.db
+
+def test_functions():
+    deck = getEmptyDeck()
+    db = deck.db
+    assert db.scalar("select field(?, 1)", u"a\x1fb") == "b"
+    assert db.scalar("select field(?, 2)", u"a\x1fb") == ""
+    assert db.scalar("select stripHTML('<b>a</b>')") == "a"
+    assert db.scalar("select fieldChecksum('a')") == 2264392759
+    assert db.scalar("select 'abc' regexp 'b.'")
+    assert not db.scalar("select 'abc' regexp '^b'")
+    f = deck.newNote()
+    f['Front'] = u"one"
+    f['Back'] = u"<i>two</i>"
+    deck.addNote(f)
+    # the field cache is rebuilt inside sqlite
+    db.execute("update notes set sfld = '', csum = 0")
+    deck.updateFieldCache([f.id])
+    assert db.first("select sfld, csum from notes") == ("one", 4261788892)
+    # patterns apply to each field, not the joined string
+    assert deck.findReplace([f.id], "^two", "three", regex=True) == 0
+    assert deck.findReplace([f.id], "^<i>", "", regex=True) == 1
+    f.load()
+    assert f['Back'] == "two</i>"
@@ -31,9 +31,13 @@ def test_anki2():
     src.close()
     # create a new empty deck
     dst = getEmptyDeck()
+    # as made before incremental vacuum
+    dst.db.execute("pragma auto_vacuum = none")
+    dst.db.execute("vacuum")
     # import src into dst
     imp = Anki2Importer(dst, srcpath)
     imp.run()
+    assert dst.db.scalar("pragma auto_vacuum") == 2
     def check():
         assert dst.noteCount() == srcNotes
         assert dst.cardCount() == srcCards
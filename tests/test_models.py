@@ -224,3 +224,27 @@ def test_modelChange():
     assert f['Notes'] == "b2"
     assert len(f.cards()) == 2
     assert "b2" in f.cards()[0].a()
+
+def test_genCardsBatches():
+    import anki.collection
+    deck = getEmptyDeck()
+    m = deck.models.current()
+    for i in range(5):
+        f = deck.newNote()
+        f['Front'] = u"%d" % i
+        f['Back'] = u"b" if i % 2 else u""
+        deck.addNote(f)
+    assert deck.models.availOrds(m, u"1\x1f") == [0]
+    # adding a template recompiles the requirements
+    t = deck.models.newTemplate("Reverse")
+    t['qfmt'] = "{{Back}}"
+    t['afmt'] = "{{Front}}"
+    deck.models.addTemplate(m, t)
+    old = anki.collection.ITER_BATCH
+    anki.collection.ITER_BATCH = 2
+    try:
+        assert deck.genCards(deck.models.nids(m)) == []
+    finally:
+        anki.collection.ITER_BATCH = old
+    assert deck.models.availOrds(m, u"1\x1fb") == [0, 1]
+    assert deck.cardCount() == 7
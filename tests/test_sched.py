@@ -776,6 +776,11 @@ def test_deckDue():
     assert tree[0][4][0][1] == default1
     assert tree[0][4][0][2] == 1
     assert tree[0][4][0][3] == 0
+    # the whole tree is counted with one query
+    prof = d.db.profile()
+    d.sched.deckDueTree()
+    d.db.profile(False)
+    assert sum(x['count'] for x in prof.stats()) == 1
     # code should not fail if a card has an invalid deck
     c.did = 12345; c.flush()
     d.sched.deckDueList()
@@ -882,3 +887,193 @@ def test_resched():
     assert c.due == d.sched.today+1
     assert c.ivl == +1
 
+
+def test_dueTotals():
+    d = getEmptyDeck()
+    for i in range(4):
+        f = d.newNote()
+        f['Front'] = u"%d" % i
+        d.addNote(f)
+    d.reset()
+    assert d.sched.counts() == (4, 0, 0)
+    def check():
+        # the totals are kept current, and match a fresh count
+        assert d.sched._totalsCurrent()
+        kept = dict((k, v) for k, v in d.sched._totals.items() if any(v))
+        d.sched._totals = None
+        assert dict((k, v) for k, v in d.sched._dueTotals().items()
+                    if any(v)) == kept
+    d.sched.answerCard(d.sched.getCard(), 2)
+    check()
+    cids = d.db.list("select id from cards where queue = 0")
+    d.sched.suspendCards(cids[:1])
+    check()
+    d.sched.unsuspendCards(cids[:1])
+    check()
+    d.sched.buryNote(d.getCard(cids[1]).nid)
+    check()
+    d.decks.setDeck(cids[2:], d.decks.id("foo"))
+    check()
+    d.remCards(cids[2:])
+    check()
+    d.reset()
+    assert d.sched.counts() == (1, 1, 0)
+    # other writes mean they're counted again
+    d.db.execute("update cards set queue = 0")
+    assert not d.sched._totalsCurrent()
+    d.reset()
+    assert d.sched.counts()[0] == d.cardCount() == 3
+
+def test_queueFill():
+    d = getEmptyDeck()
+    child = d.decks.id("Default::child")
+    for did in 1, child:
+        for i in range(3):
+            f = d.newNote()
+            f['Front'] = u"%d" % i
+            f.did = did
+            d.addNote(f)
+    d.db.execute("update cards set type=2, queue=2, due=?, ivl=nid%10+1",
+                 d.sched.today)
+    conf = d.decks.confForDid(1)
+    conf['rev']['perDay'] = 4
+    conf['rev']['order'] = 1
+    d.reset()
+    assert d.sched.counts() == (0, 0, 4)
+    # both decks are fetched at once, within the parent's limit
+    prof = d.db.profile()
+    d.sched._fillRev()
+    d.db.profile(False)
+    assert sum(x['count'] for x in prof.stats()) == 1
+    ids = list(reversed(d.sched._revQueue))
+    assert len(ids) == 4
+    cards = [d.getCard(id) for id in ids]
+    # parent first, in the configured order
+    assert [c.did for c in cards] == [1, 1, 1, child]
+    ivls = [c.ivl for c in cards[:3]]
+    assert ivls == sorted(ivls, reverse=True)
+    # only queueLimit cards are fetched at a time
+    d.sched.queueLimit = 3
+    d.reset()
+    d.sched._fillRev()
+    assert len(d.sched._revQueue) == 3
+
+def test_newSiblings():
+    d = getEmptyDeck()
+    m = d.models.current(); mm = d.models
+    t = mm.newTemplate("Reverse")
+    t['qfmt'] = "{{Back}}"
+    t['afmt'] = "{{Front}}"
+    mm.addTemplate(m, t)
+    mm.save(m)
+    child = d.decks.id("Default::child")
+    nids = []
+    for did in 1, 1, child:
+        f = d.newNote()
+        f['Front'] = u"1"; f['Back'] = u"2"
+        f.did = did
+        d.addNote(f)
+        nids.append(f.id)
+    d.reset()
+    cards = [d.sched.getCard() for i in range(6)]
+    # siblings are moved behind the rest of their own deck only
+    assert [c.nid for c in cards] == [nids[0], nids[1], nids[0], nids[1],
+                                      nids[2], nids[2]]
+
+def test_prefetch():
+    d = getEmptyDeck()
+    for i in range(3):
+        f = d.newNote()
+        f['Front'] = u"q%d" % i
+        d.addNote(f)
+    d.reset()
+    c = d.sched.getCard()
+    assert len(d.sched._prefetched) == 2
+    # answering keeps the rest, which are shown without reading the db
+    d.sched.answerCard(c, 3)
+    assert len(d.sched._prefetched) == 2
+    prof = d.db.profile()
+    c = d.sched.getCard()
+    d.db.profile(False)
+    assert "select * from cards" not in str(prof.stats())
+    assert c._qa and c.q(reload=False).endswith(c.note()['Front'])
+    # an edited note isn't shown from the cache
+    nid = d.db.scalar("select nid from cards where id = ?",
+                      d.sched._newQueue[-1][0])
+    f = d.getNote(nid)
+    f['Front'] = u"changed"
+    f.flush()
+    d.sched.answerCard(c, 3)
+    c = d.sched.getCard()
+    assert c.note()['Front'] == u"changed"
+    assert u"changed" in c.q()
+
+def test_prefetchModelChange():
+    d = getEmptyDeck()
+    for i in range(3):
+        f = d.newNote()
+        f['Front'] = u"q%d" % i
+        d.addNote(f)
+    d.reset()
+    d.sched.answerCard(d.sched.getCard(), 3)
+    # template changes that haven't been written yet are shown
+    m = d.models.current()
+    m['tmpls'][0]['qfmt'] = "CHANGED {{Front}}"
+    d.models.save(m)
+    d.reset()
+    assert d.sched.getCard().q().endswith("CHANGED q1")
+    # and so is a renamed deck
+    m['tmpls'][0]['qfmt'] = "{{Deck}}"
+    d.models.save(m)
+    d.reset()
+    d.sched.prefetchCards()
+    d.decks.rename(d.decks.get(1), u"renamed")
+    assert d.sched.getCard().q().endswith("renamed")
+
+def test_answerCards():
+    d = getEmptyDeck()
+    for i in range(3):
+        f = d.newNote()
+        f['Front'] = u"%d" % i
+        d.addNote(f)
+    cids = d.db.list("select id from cards order by id")
+    d.reset()
+    assert d.sched.counts() == (3, 0, 0)
+    t = intTime() - 100
+    day = int((t - d.crt) / 86400)
+    # an unknown card stops the batch before anything is changed
+    assertException(Exception, lambda: d.sched.answerCards(
+        [(cids[0], 2, 5000, t), (1, 2, 5000, t)]))
+    assert d.getCard(cids[0]).reps == 0
+    assert not d.undoName()
+    # the first card is learnt twice and graduates; taken times are capped
+    d.sched.answerCards([(cids[0], 2, 5000, t),
+                         (cids[1], 3, 10**7, t),
+                         (cids[0], 2, 3000, t + 60)])
+    c = d.getCard(cids[0])
+    assert c.queue == c.type == 2
+    assert c.reps == 2 and c.due == day + 1
+    c = d.getCard(cids[1])
+    assert c.queue == 2 and c.due == day + 4
+    # reviews at the same time get the next free id
+    log = d.db.all("select id, cid, time from revlog order by id")
+    assert log == [(t*1000, cids[0], 5000), (t*1000+1, cids[1], 60000),
+                   ((t+60)*1000, cids[0], 3000)]
+    g = d.decks.get(1)
+    assert g['newToday'][1] == 2
+    assert g['timeToday'][1] == 68000
+    # the queues are reset, and undo goes back a review at a time
+    assert d.sched.counts() == (1, 0, 0)
+    d.undo()
+    assert d.getCard(cids[0]).queue == 1
+    assert d.db.scalar("select count() from revlog") == 2
+    # ids are found past a run of taken ones, and reviews from an earlier
+    # day are scheduled from that day
+    t -= 86400*3
+    for i in range(5):
+        d.db.execute("insert into revlog values (?,0,0,0,0,0,0,0,0)",
+                     t*1000+i)
+    d.sched.answerCards([(cids[2], 3, 1000, t)])
+    assert d.db.scalar("select max(id) from revlog where cid = ?",
+                       cids[2]) == t*1000+5
+    assert d.getCard(cids[2]).due == day - 3 + 4
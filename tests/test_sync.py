@@ -50,6 +50,19 @@ def setup_modified():
     deck1.setMod()
     deck1.save()
 
+def setup_tables():
+    setup_basic()
+    # converting is a schema change, so reset the schema and mod times
+    t = intTime(1000)
+    for d in deck1, deck2:
+        d.useRegistryTables()
+        d.scm = 0
+        d.setMod()
+        d.save(mod=t)
+    # and mark deck1 as changed
+    deck1.setMod()
+    deck1.save(mod=t+1)
+
 @nose.with_setup(setup_basic)
 def test_nochange():
     assert client.sync() == "noChanges"
@@ -91,6 +104,13 @@ def test_sync():
     assert client.sync() == "success"
     check(2)
 
+@nose.with_setup(setup_tables)
+def test_syncTables():
+    test_sync()
+    for d in deck1, deck2:
+        assert d.db.scalar("select count() from models") == 4
+        assert d.db.scalar("select count() from tags") == 2
+
 @nose.with_setup(setup_modified)
 def test_models():
     test_sync()
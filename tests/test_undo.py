@@ -86,3 +86,31 @@ def test_review():
     assert not d.undoName()
 
 
+
+def test_reviewLimit():
+    d = getEmptyDeck()
+    d.undoLimit = 2
+    for i in range(3):
+        f = d.newNote()
+        f['Front'] = u"%d" % i
+        d.addNote(f)
+    d.reset()
+    for i in range(3):
+        d.sched.answerCard(d.sched.getCard(), 2)
+    assert d.db.scalar("select count() from revlog") == 3
+    # only the last two answers are kept
+    d.undo()
+    d.undo()
+    assert not d.undoName()
+    assert d.db.scalar("select count() from revlog") == 1
+    assert d.db.scalar("select count() from cards where queue = 0") == 2
+
+def test_opKeepsRegistries():
+    d = getEmptyDeck()
+    models = d.models.models
+    d.save("foo")
+    d.decks.id("new deck")
+    d.undo()
+    # the unchanged model registry wasn't reloaded
+    assert d.models.models is models
+    assert "new deck" not in d.decks.allNames()